@@ -0,0 +1,306 @@
+#! /usr/bin/env python3
+import json
+import math
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime
+
+import click
+from thrift.protocol import TMultiplexedProtocol
+from thrift.transport import TSocket
+
+from bxcli import config
+from bxcli.tfclient import make_protocol, pipelined, service, wrap_transport
+from bxcli.tf.boxes.ttypes import AddBy, FetchBy, LinkType
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# codec name: (protocol, accelerate)
+CODECS = {
+    'binary': ('binary', False),
+    'accelerated': ('binary', True),
+    'compact': ('compact', True),
+}
+
+
+def _method(service_name, method, args, prepare=None):
+    return {'service': service_name, 'method': method, 'args': args, 'prepare': prepare}
+
+
+def _new_boxes(ctx, clients):
+    # ids of the boxes made by the create phase, removed by the remove phase
+    ids = set(b.id for b in clients['BoxService'].currentBoxes())
+    ctx['created_boxes'] = sorted(ids - ctx['boxes'])
+    ctx['boxes'] = ids - set(ctx['created_boxes'])
+
+
+# Every method of the three services, in an order that keeps the calls valid:
+# a phase only uses what earlier phases of the same round made. args(i, ctx)
+# returns the arguments of call i; paths of a round live under ctx['dir'].
+METHODS = [
+    _method('BoxService', 'currentBoxes', lambda i, c: ()),
+    _method('BoxService', 'get', lambda i, c: (1,)),
+    _method('BoxService', 'setName', lambda i, c: (2, 'box2')),
+    _method('BoxService', 'setDescription', lambda i, c: (2, 'description {}'.format(i))),
+    _method('BoxService', 'archive', lambda i, c: (2,)),
+    _method('BoxService', 'unarchive', lambda i, c: (2,)),
+    _method('BoxService', 'create', lambda i, c: ('bench{}'.format(i), '')),
+    _method('BoxService', 'remove', lambda i, c: (c['created_boxes'][i],), prepare=_new_boxes),
+
+    _method('FileService', 'ls', lambda i, c: (1, '/d{}'.format(i % c['dirs']))),
+    _method('FileService', 'add', lambda i, c: (1, '{}/a{}'.format(c['dir'], i), '/dev/null', AddBy.COPY)),
+    _method('FileService', 'fetch', lambda i, c: (1, '{}/a{}'.format(c['dir'], i), '/dev/null', FetchBy.COPY)),
+    _method('FileService', 'innerMove', lambda i, c: (1, '{}/a{}'.format(c['dir'], i), '{}/b{}'.format(c['dir'], i))),
+    _method('FileService', 'innerCopy', lambda i, c: (1, '{}/b{}'.format(c['dir'], i), '{}/c{}'.format(c['dir'], i))),
+    _method('FileService', 'move', lambda i, c: (1, '{}/b{}'.format(c['dir'], i), 2, '{}/b{}'.format(c['dir'], i))),
+    _method('FileService', 'copy', lambda i, c: (1, '{}/c{}'.format(c['dir'], i), 2, '{}/c{}'.format(c['dir'], i))),
+    _method('FileService', 'remove', lambda i, c: (1, '{}/c{}'.format(c['dir'], i))),
+
+    _method('LinkService', 'create', lambda i, c: (1, '/d0/f{}'.format(i % c['fanout']), '{}/l{}'.format(c['dir'], i), LinkType.SOFT)),
+    _method('LinkService', 'lsAll', lambda i, c: ()),
+    _method('LinkService', 'lsBox', lambda i, c: (1 + i % len(c['boxes']),)),
+    _method('LinkService', 'lsInner', lambda i, c: (1, '/d0/f{}'.format(i % c['fanout']))),
+    _method('LinkService', 'removeById', lambda i, c: (c['first_link'] + i,)),
+    _method('LinkService', 'removeByDestination', lambda i, c: ('{}/l{}'.format(c['dir'], i),)),
+    _method('LinkService', 'removeByInner', lambda i, c: (2, '{}/c{}'.format(c['dir'], i))),
+    _method('LinkService', 'removeByBox', lambda i, c: (c['boxes_total'] + 1,)),
+    _method('LinkService', 'removeAll', lambda i, c: ()),
+]
+
+
+class CountingSocket(TSocket.TSocket):
+    """CountingSocket counts the bytes read and written on the wire, under framing and compression"""
+
+    def __init__(self, *args, **kwargs):
+        super(CountingSocket, self).__init__(*args, **kwargs)
+        self.sent = 0
+        self.received = 0
+
+    def read(self, sz):
+        buff = super(CountingSocket, self).read(sz)
+        self.received += len(buff)
+        return buff
+
+    def write(self, buff):
+        super(CountingSocket, self).write(buff)
+        self.sent += len(buff)
+
+
+class Connection(object):
+    """Connection holds one client of every service over a counted socket, set up like boxes does"""
+
+    def __init__(self, port):
+        self.sock = CountingSocket('127.0.0.1', port)
+        self.transport = wrap_transport(self.sock)
+        protocol = make_protocol(self.transport)
+        self.transport.open()
+        self.clients = dict((name, service(name).Client(TMultiplexedProtocol.TMultiplexedProtocol(protocol, name)))
+                            for name in ('BoxService', 'FileService', 'LinkService'))
+
+    def close(self):
+        self.transport.close()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def start_server(port, env, boxes, files, links, fanout, latency):
+    """start_server runs bench.server, with latency in ms, in a child process and waits until it accepts connections"""
+    proc = subprocess.Popen([sys.executable, '-m', 'bench.server', '-H', '127.0.0.1', '-P', str(port),
+                             '-n', str(boxes), '-m', str(files), '-k', str(links), '--fanout', str(fanout),
+                             '--latency', str(latency)],
+                            cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return proc
+        except OSError:
+            if proc.poll() is not None:
+                break
+            time.sleep(0.05)
+    proc.kill()
+    raise Exception('stand-in server did not start on port {}'.format(port))
+
+
+def restore_links(client, boxes, files, links, fanout):
+    """restore_links makes again the links the server was started with, the removeAll phase dropped them"""
+    calls = []
+    for k in range(links):
+        box_id, i = k % boxes + 1, (k // boxes) % files
+        calls.append((box_id, '/d{}/f{}'.format(i // fanout, i), '/srv/links/{}/{}'.format(box_id, k), k % 2))
+    for _, _, error in pipelined(client, 'create', calls, 64):
+        if error is not None:
+            raise error
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    return samples[max(int(math.ceil(p / 100.0 * len(samples))) - 1, 0)]
+
+
+def run_phase(spec, ctx, connections, calls):
+    """run_phase makes calls of one method spread over the connections, one thread each"""
+    latencies = [[] for _ in connections]
+    errors = [0] * len(connections)
+    before = [(c.sock.sent, c.sock.received) for c in connections]
+
+    def work(n):
+        client = getattr(connections[n].clients[spec['service']], spec['method'])
+        for i in range(n, calls, len(connections)):
+            start = time.perf_counter()
+            try:
+                client(*spec['args'](i, ctx))
+            except Exception:
+                errors[n] += 1
+            latencies[n].append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(len(connections))]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    samples = sorted(l for thread in latencies for l in thread)
+    sent = sum(c.sock.sent - s for c, (s, _) in zip(connections, before))
+    received = sum(c.sock.received - r for c, (_, r) in zip(connections, before))
+    return {
+        'calls': calls,
+        'errors': sum(errors),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3),
+        'p95_ms': round(percentile(samples, 95) * 1000, 3),
+        'p99_ms': round(percentile(samples, 99) * 1000, 3),
+        'ops_per_s': round(calls / elapsed, 1),
+        'bytes_sent_per_call': round(sent / float(calls), 1),
+        'bytes_received_per_call': round(received / float(calls), 1),
+    }
+
+
+def run_combination(codec, transport, zlib, concurrency, calls, methods, dataset, latency):
+    """run_combination benchmarks every method at every concurrency against a fresh server"""
+    protocol, accelerate = CODECS[codec]
+    env = dict(os.environ, BXCLI_PROTOCOL=protocol, BXCLI_ACCELERATE='yes' if accelerate else 'no',
+               BXCLI_TRANSPORT=transport, BXCLI_ZLIB=str(zlib), BXCLI_CONFIG=os.devnull)
+    env.pop('BXCLI_ENDPOINTS', None)
+    config.override('protocol', protocol)
+    config.override('accelerate', accelerate)
+    config.override('transport', transport)
+    config.override('zlib', zlib)
+
+    boxes, files, links, fanout = dataset
+    port = free_port()
+    server = start_server(port, env, boxes, files, links, fanout, latency)
+    results = {}
+    ctx = {'dirs': max(files // fanout, 1), 'fanout': min(fanout, files), 'boxes_total': boxes,
+           'first_link': links + 1}
+    try:
+        for round, c in enumerate(concurrency):
+            connections = [Connection(port) for _ in range(c)]
+            try:
+                if ctx.pop('links_dropped', False):
+                    restore_links(connections[0].clients['LinkService'], boxes, files, links, fanout)
+                    ctx['first_link'] += links
+                ctx['dir'] = '/bench/r{}'.format(round)
+                ctx['boxes'] = set(b.id for b in connections[0].clients['BoxService'].currentBoxes())
+                level = {}
+                for spec in METHODS:
+                    if spec['prepare'] is not None:
+                        spec['prepare'](ctx, connections[0].clients)
+                    name = '{}.{}'.format(spec['service'], spec['method'])
+                    if methods and name not in methods and spec['method'] not in methods:
+                        continue
+                    level[name] = run_phase(spec, ctx, connections, calls)
+                    if spec['method'] == 'removeAll':
+                        ctx['links_dropped'] = True
+                # links made by this round got the next ids
+                if 'LinkService.create' in level:
+                    ctx['first_link'] += calls
+                results[str(c)] = level
+            finally:
+                for conn in connections:
+                    conn.close()
+    finally:
+        server.kill()
+        server.wait()
+    return results
+
+
+def thrift_version():
+    try:
+        from importlib import metadata
+        return metadata.version('thrift')
+    except Exception:
+        return None
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=ROOT, stderr=subprocess.DEVNULL,
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.command()
+@click.option('--codec', '-c', 'codecs', type=click.Choice(sorted(CODECS)), multiple=True,
+              help='Codec to measure, repeat for several, default to all')
+@click.option('--transport', '-t', 'transports', type=click.Choice(config.TRANSPORTS), multiple=True,
+              help='Transport to measure, repeat for several, default to all')
+@click.option('--zlib', type=click.IntRange(0, 9), multiple=True, help='zlib level to measure, repeat for several, default to 0')
+@click.option('--concurrency', '-j', type=click.IntRange(1), multiple=True, help='Number of connections calling at once, repeat for several, default to 1, 4 and 16')
+@click.option('--calls', '-n', type=click.IntRange(1), default=200, help='Calls per method and concurrency, default to 200')
+@click.option('--method', '-m', 'methods', multiple=True, help='Only measure this method, as name or Service.name, repeat for several')
+@click.option('--boxes', type=click.IntRange(2), default=10, help='Boxes served, default to 10')
+@click.option('--files', type=click.IntRange(1), default=1000, help='Files per box served, default to 1000')
+@click.option('--links', type=click.IntRange(0), default=1000, help='Links served, default to 1000')
+@click.option('--fanout', type=click.IntRange(1), default=100, help='Files per served directory, default to 100')
+@click.option('--latency', type=float, default=0, help='Milliseconds the server waits before every call')
+@click.option('--output', '-o', type=click.File('w'), default='-', help='File the JSON results are written to, default to stdout')
+def rpc(codecs, transports, zlib, concurrency, calls, methods, boxes, files, links, fanout, latency, output):
+    """Measure every service method over every protocol and transport combination
+
+    For each combination a stand-in server (bench.server) is started, then
+    every method of BoxService, FileService and LinkService is called at each
+    concurrency, each connection from its own thread. Latency percentiles,
+    throughput and bytes on the wire per call are written as JSON, and a
+    summary is printed on stderr. Run it as python -m bench.rpc from the
+    repository root.
+    """
+    combinations = [(c, t, z) for c in codecs or sorted(CODECS)
+                    for t in transports or config.TRANSPORTS for z in zlib or (0,)]
+    report = {
+        'started': datetime.now().isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'thrift': thrift_version(),
+        'parameters': {'calls': calls, 'concurrency': list(concurrency or (1, 4, 16)), 'boxes': boxes,
+                       'files': files, 'links': links, 'fanout': fanout, 'latency_ms': latency},
+        'results': [],
+    }
+    for codec, transport, level in combinations:
+        click.echo('{} over {}{}'.format(codec, transport, ' zlib {}'.format(level) if level else ''), err=True)
+        results = run_combination(codec, transport, level, concurrency or (1, 4, 16), calls, methods,
+                                  (boxes, files, links, fanout), latency)
+        for c, level_results in results.items():
+            for name, r in level_results.items():
+                click.echo('  j={:<3} {:<32} p50 {:>8.3f}ms  p99 {:>8.3f}ms  {:>9.1f}/s  {:>9.1f}B out  {:>9.1f}B in{}'.format(
+                    c, name, r['p50_ms'], r['p99_ms'], r['ops_per_s'], r['bytes_sent_per_call'],
+                    r['bytes_received_per_call'], '  {} errors'.format(r['errors']) if r['errors'] else ''), err=True)
+        report['results'].append({'codec': codec, 'transport': transport, 'zlib': level, 'concurrency': results})
+    json.dump(report, output, indent=2)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    rpc()
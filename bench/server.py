@@ -0,0 +1,345 @@
+#! /usr/bin/env python3
+import posixpath
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+
+import click
+from thrift.TMultiplexedProcessor import TMultiplexedProcessor
+from thrift.server import TServer
+from thrift.transport import TSocket
+
+from bxcli import config
+from bxcli.tf.boxes import BoxService, FileService, LinkService
+from bxcli.tf.boxes.ttypes import Box, BoxStatus, FetchBy, Link, LsItem, LsType, ServiceException
+from bxcli.tfclient import make_protocol, wrap_transport
+
+
+def normalize(path):
+    return posixpath.normpath('/' + path.lstrip('/'))
+
+
+class Store(object):
+    """Store holds boxes, the paths inside them and links in memory, behind one lock
+
+    The paths of a box are kept per directory, as {inner dir: {name: LsType}}.
+    Outer paths given to add and fetch are never read or written, an added
+    path is a file.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.boxes = {}
+        self.dirs = {}
+        self.links = {}
+        self.next_box = 1
+        self.next_link = 1
+
+    def box(self, op, id, writable=False):
+        box = self.boxes.get(id)
+        if box is None:
+            raise ServiceException(op, 'box {} does not exist'.format(id))
+        if writable and box.status == BoxStatus.ARCHIVED:
+            raise ServiceException(op, 'box {} is archived'.format(id))
+        return box
+
+    def create_box(self, name, description):
+        box = Box(self.next_box, name, description, BoxStatus.OPEN, datetime.now().isoformat(' ', 'seconds'))
+        self.boxes[box.id] = box
+        self.dirs[box.id] = {'/': {}}
+        self.next_box += 1
+        return box
+
+    def type(self, box_id, path):
+        path = normalize(path)
+        if path == '/':
+            return LsType.DIR
+        return self.dirs[box_id].get(posixpath.dirname(path), {}).get(posixpath.basename(path))
+
+    def put(self, box_id, path, type):
+        dirs = self.dirs[box_id]
+        path = normalize(path)
+        parent = posixpath.dirname(path)
+        if parent not in dirs:
+            self.put(box_id, parent, LsType.DIR)
+        dirs[parent][posixpath.basename(path)] = type
+        if type == LsType.DIR:
+            dirs.setdefault(path, {})
+
+    def delete(self, box_id, path):
+        dirs = self.dirs[box_id]
+        path = normalize(path)
+        dirs[posixpath.dirname(path)].pop(posixpath.basename(path), None)
+        prefix = path.rstrip('/') + '/'
+        for d in [d for d in dirs if d == path or d.startswith(prefix)]:
+            del dirs[d]
+
+    def copy(self, src_box, src_path, dst_box, dst_path):
+        src_path, dst_path = normalize(src_path), normalize(dst_path)
+        type = self.type(src_box, src_path)
+        self.put(dst_box, dst_path, type)
+        if type != LsType.DIR:
+            return
+        for name, child_type in list(self.dirs[src_box][src_path].items()):
+            self.copy(src_box, posixpath.join(src_path, name), dst_box, posixpath.join(dst_path, name))
+
+    def add_link(self, link):
+        self.links[self.next_link] = link
+        self.next_link += 1
+
+    def remove_links(self, keep):
+        self.links = dict((i, l) for i, l in self.links.items() if keep(i, l))
+
+
+class BoxHandler(BoxService.Iface):
+
+    def __init__(self, store):
+        self.store = store
+
+    def create(self, name, description):
+        with self.store.lock:
+            self.store.create_box(name, description)
+
+    def remove(self, id):
+        with self.store.lock:
+            self.store.box('remove', id)
+            del self.store.boxes[id]
+            del self.store.dirs[id]
+
+    def setDescription(self, id, description):
+        with self.store.lock:
+            self.store.box('setDescription', id).description = description
+
+    def setName(self, id, name):
+        with self.store.lock:
+            self.store.box('setName', id).name = name
+
+    def archive(self, id):
+        with self.store.lock:
+            self.store.box('archive', id).status = BoxStatus.ARCHIVED
+
+    def unarchive(self, id):
+        with self.store.lock:
+            self.store.box('unarchive', id).status = BoxStatus.OPEN
+
+    def currentBoxes(self):
+        with self.store.lock:
+            return [self.store.boxes[i] for i in sorted(self.store.boxes)]
+
+    def get(self, id):
+        with self.store.lock:
+            return self.store.box('get', id)
+
+
+class FileHandler(FileService.Iface):
+
+    def __init__(self, store):
+        self.store = store
+
+    def existing(self, op, box_id, path, writable=False):
+        self.store.box(op, box_id, writable)
+        if self.store.type(box_id, path) is None:
+            raise ServiceException(op, '{}:{} does not exist'.format(box_id, path))
+
+    def add(self, boxId, innerPath, outerPath, addBy):
+        with self.store.lock:
+            self.store.box('add', boxId, writable=True)
+            if self.store.type(boxId, innerPath) is not None:
+                raise ServiceException('add', '{}:{} already exists'.format(boxId, innerPath))
+            self.store.put(boxId, innerPath, LsType.FILE)
+
+    def fetch(self, boxId, innerPath, outerPath, fetchBy):
+        with self.store.lock:
+            self.existing('fetch', boxId, innerPath, writable=fetchBy == FetchBy.MOVE)
+            if fetchBy == FetchBy.MOVE:
+                self.store.delete(boxId, innerPath)
+
+    def remove(self, boxId, innerPath):
+        with self.store.lock:
+            self.existing('remove', boxId, innerPath, writable=True)
+            if normalize(innerPath) == '/':
+                raise ServiceException('remove', 'cannot remove the root of a box')
+            self.store.delete(boxId, innerPath)
+
+    def ls(self, boxId, innerDir):
+        with self.store.lock:
+            self.existing('ls', boxId, innerDir)
+            if self.store.type(boxId, innerDir) != LsType.DIR:
+                raise ServiceException('ls', '{}:{} is not a directory'.format(boxId, innerDir))
+            entries = self.store.dirs[boxId][normalize(innerDir)]
+            return [LsItem(name, entries[name]) for name in sorted(entries)]
+
+    def move(self, srcBoxId, srcInnerPath, dstBoxId, dstInnerPath):
+        with self.store.lock:
+            self.existing('move', srcBoxId, srcInnerPath, writable=True)
+            self.store.box('move', dstBoxId, writable=True)
+            self.store.copy(srcBoxId, srcInnerPath, dstBoxId, dstInnerPath)
+            self.store.delete(srcBoxId, srcInnerPath)
+
+    def copy(self, srcBoxId, srcInnerPath, dstBoxId, dstInnerPath):
+        with self.store.lock:
+            self.existing('copy', srcBoxId, srcInnerPath)
+            self.store.box('copy', dstBoxId, writable=True)
+            self.store.copy(srcBoxId, srcInnerPath, dstBoxId, dstInnerPath)
+
+    def innerMove(self, boxId, srcInnerPath, dstInnerPath):
+        self.move(boxId, srcInnerPath, boxId, dstInnerPath)
+
+    def innerCopy(self, boxId, srcInnerPath, dstInnerPath):
+        self.copy(boxId, srcInnerPath, boxId, dstInnerPath)
+
+
+class LinkHandler(LinkService.Iface):
+
+    def __init__(self, store):
+        self.store = store
+
+    def create(self, boxId, innerPath, destination, linkType):
+        with self.store.lock:
+            self.store.box('create', boxId)
+            if self.store.type(boxId, innerPath) is None:
+                raise ServiceException('create', '{}:{} does not exist'.format(boxId, innerPath))
+            self.store.add_link(Link(boxId, innerPath, destination, linkType))
+
+    def lsAll(self):
+        with self.store.lock:
+            return list(self.store.links.values())
+
+    def lsBox(self, boxId):
+        with self.store.lock:
+            return [l for l in self.store.links.values() if l.boxId == boxId]
+
+    def lsInner(self, boxId, innerPath):
+        with self.store.lock:
+            return [l for l in self.store.links.values() if l.boxId == boxId and l.innerPath == innerPath]
+
+    def removeAll(self):
+        with self.store.lock:
+            self.store.links = {}
+
+    def removeById(self, id):
+        with self.store.lock:
+            if id not in self.store.links:
+                raise ServiceException('removeById', 'link {} does not exist'.format(id))
+            del self.store.links[id]
+
+    def removeByBox(self, boxId):
+        with self.store.lock:
+            self.store.remove_links(lambda i, l: l.boxId != boxId)
+
+    def removeByInner(self, boxId, innerPath):
+        with self.store.lock:
+            self.store.remove_links(lambda i, l: (l.boxId, l.innerPath) != (boxId, innerPath))
+
+    def removeByDestination(self, destination):
+        with self.store.lock:
+            self.store.remove_links(lambda i, l: l.destination != destination)
+
+
+class Delayed(object):
+    """Delayed sleeps latency seconds, plus up to jitter more, before every call of a handler"""
+
+    def __init__(self, handler, latency, jitter=0):
+        self.handler = handler
+        self.latency = latency
+        self.jitter = jitter
+
+    def __getattr__(self, name):
+        method = getattr(self.handler, name)
+
+        def delayed(*args):
+            time.sleep(self.latency + random.uniform(0, self.jitter))
+            return method(*args)
+        return delayed
+
+
+def populate(store, boxes, files, links, fanout=100):
+    """populate fills a store with boxes of files spread over directories of fanout entries, and links to them
+
+    Box b holds /d<i // fanout>/f<i> for i below files. Link k points to a
+    file of box k % boxes + 1 from /srv/links/<box>/<k>, soft and hard in turn.
+    """
+    with store.lock:
+        for b in range(boxes):
+            box = store.create_box('box{}'.format(b + 1), 'generated box {}'.format(b + 1))
+            for i in range(files):
+                store.put(box.id, '/d{}/f{}'.format(i // fanout, i), LsType.FILE)
+        if not boxes or not files:
+            return
+        for k in range(links):
+            box_id, i = k % boxes + 1, (k // boxes) % files
+            store.add_link(Link(box_id, '/d{}/f{}'.format(i // fanout, i),
+                                '/srv/links/{}/{}'.format(box_id, k), k % 2))
+
+
+class TransportFactory(object):
+    """TransportFactory stacks the configured compression and framing, like the client does"""
+
+    def getTransport(self, trans):
+        return wrap_transport(trans)
+
+
+class ProtocolFactory(object):
+    """ProtocolFactory builds the configured protocol, like the client does"""
+
+    def getProtocol(self, trans):
+        return make_protocol(trans)
+
+
+def make_server(store, latency=0, jitter=0):
+    """make_server returns a threaded server of the three services over store, on the first configured endpoint"""
+    processor = TMultiplexedProcessor()
+    for name, service, handler in (('BoxService', BoxService, BoxHandler),
+                                   ('FileService', FileService, FileHandler),
+                                   ('LinkService', LinkService, LinkHandler)):
+        h = handler(store)
+        if latency or jitter:
+            h = Delayed(h, latency, jitter)
+        processor.registerProcessor(name, service.Processor(h))
+    endpoint = config.endpoints()[0]
+    if endpoint.unix_socket is not None:
+        socket = TSocket.TServerSocket(unix_socket=endpoint.unix_socket)
+    else:
+        socket = TSocket.TServerSocket(host=endpoint.host, port=endpoint.port)
+    server = TServer.TThreadedServer(processor, socket, TransportFactory(), ProtocolFactory(), daemon=True)
+    return server
+
+
+@click.command()
+@click.option('--host', '-H', help='Host to listen on, default to the host setting')
+@click.option('--port', '-P', type=int, help='Port to listen on, default to the port setting')
+@click.option('--socket', '-S', help='Listen on a unix socket at this path instead')
+@click.option('--boxes', '-n', type=click.IntRange(0), default=10, help='Number of generated boxes, default to 10')
+@click.option('--files', '-m', type=click.IntRange(0), default=1000, help='Number of generated files per box, default to 1000')
+@click.option('--links', '-k', type=click.IntRange(0), default=1000, help='Number of generated links, default to 1000')
+@click.option('--fanout', type=click.IntRange(1), default=100, help='Number of files per generated directory, default to 100')
+@click.option('--latency', type=float, default=0, help='Milliseconds every call waits before it is served')
+@click.option('--jitter', type=float, default=0, help='Up to this many more random milliseconds every call waits')
+def server(host, port, socket, boxes, files, links, fanout, latency, jitter):
+    """Serve BoxService, FileService and LinkService from memory, for benchmarks
+
+    Run it as python -m bench.server from the repository root. The protocol,
+    transport and zlib settings of bxcli apply, so the server speaks whatever
+    boxes is configured to speak.
+    """
+    config.override('host', host)
+    config.override('port', port)
+    config.override('socket', socket)
+    if host is not None or port is not None or socket is not None:
+        config.override('endpoints', '')
+    store = Store()
+    populate(store, boxes, files, links, fanout)
+    srv = make_server(store, latency / 1000, jitter / 1000)
+    click.echo('serving {} boxes, {} files, {} links on {} with {} over {}{}'.format(
+        boxes, boxes * files, links, config.endpoints()[0], config.protocol(), config.transport(),
+        ' and zlib' if config.zlib() else ''), err=True)
+    try:
+        srv.serve()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(server())
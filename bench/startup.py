@@ -0,0 +1,265 @@
+#! /usr/bin/env python3
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import click
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# every subcommand, with arguments that put a request on the wire right after parsing them
+COMMANDS = [
+    'list',
+    'inspect 1',
+    'create bench',
+    'remove 1',
+    'set-name 1 bench',
+    'set-description 1 bench',
+    'archive 1',
+    'unarchive 1',
+    'add 1:/ /tmp/bxcli-bench-add',
+    'fetch 1:/a /tmp/bxcli-bench-fetch',
+    'rm 1:/a',
+    'ls 1:/',
+    'find 1:/ --name x',
+    'copy 1:/a 1:/b',
+    'move 1:/a 1:/b',
+    'link 1:/a /tmp/bxcli-bench-link',
+    'ls-link',
+    'ls-link 1',
+    'rm-link -b 1',
+    'check-links',
+    'reconcile-links',
+    'agent status',
+    'shell',
+    'batch',
+]
+
+# what commands read on stdin: confirmations are accepted, shell and batch get a command line
+STDIN = {'shell': 'list\n', 'batch': 'list\n'}
+
+# runs a command in place of -X importtime, which misses the modules LazyGroup and tfclient.service load
+# with importlib.import_module; every import, statement or call, goes through importlib._bootstrap._find_and_load
+IMPORT_TIMER = """
+import atexit, importlib._bootstrap as bootstrap, json, runpy, sys, time
+
+out, find_and_load, stack, times = sys.argv[1], bootstrap._find_and_load, [], {}
+
+
+def timed(name, import_):
+    if name in sys.modules:
+        return find_and_load(name, import_)
+    start = time.perf_counter_ns()
+    stack.append([name, 0])
+    try:
+        return find_and_load(name, import_)
+    finally:
+        _, children = stack.pop()
+        cumulative = (time.perf_counter_ns() - start) // 1000
+        if stack:
+            stack[-1][1] += cumulative
+        top_level = not any(n == 'bxcli' or n.startswith('bxcli.') for n, _ in stack)
+        times.setdefault(name, (cumulative - children, cumulative, top_level))
+
+
+def dump():
+    with open(out, 'w') as f:
+        json.dump(times, f)
+
+
+bootstrap._find_and_load = timed
+atexit.register(dump)
+sys.argv = sys.argv[2:]
+runpy.run_path(sys.argv[0], run_name='__main__')
+"""
+
+
+class FirstByteListener(object):
+    """FirstByteListener accepts connections and records when the first byte of a request arrives
+
+    The connection is closed right after, the command under test fails but
+    its startup has been measured.
+    """
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(16)
+        self.port = self.sock.getsockname()[1]
+        self.first_byte = None
+        self.received = threading.Event()
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def arm(self):
+        self.first_byte = None
+        self.received.clear()
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except OSError:
+                return
+            with conn:
+                if conn.recv(1) and not self.received.is_set():
+                    self.first_byte = time.perf_counter()
+                    self.received.set()
+
+    def close(self):
+        self.sock.close()
+
+
+def environment(port, pycache):
+    env = dict(os.environ)
+    env.update({
+        'BXCLI_NO_AGENT': '1',
+        'BXCLI_CACHE': 'no',
+        'BXCLI_ENDPOINTS': '127.0.0.1:{}'.format(port),
+        'BXCLI_CONFIG': os.devnull,
+        'BXCLI_HISTORY': os.devnull,
+        'PYTHONPYCACHEPREFIX': pycache,
+    })
+    env.pop('BXCLI_SOCKET', None)
+    # warm runs need the bytecode written by earlier runs
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    return env
+
+
+def stdin(command):
+    return STDIN.get(command.split()[0], 'y\n')
+
+
+def run_once(argv, listener, pycache, command):
+    """run_once returns (seconds to the first byte on the wire or None, seconds to exit)"""
+    listener.arm()
+    start = time.perf_counter()
+    subprocess.run(argv, env=environment(listener.port, pycache), cwd=ROOT, input=stdin(command),
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, universal_newlines=True, timeout=30)
+    exited = time.perf_counter() - start
+    listener.received.wait(0.1)
+    if listener.first_byte is None:
+        return None, exited
+    return listener.first_byte - start, exited
+
+
+def import_times(argv, port, pycache, command):
+    """import_times returns {module: (self us, cumulative us)} of the bxcli modules imported by a run,
+    and the us spent in top level imports of bxcli modules, dependencies included"""
+    fd, out = tempfile.mkstemp(prefix='bxcli-bench-', suffix='.json')
+    os.close(fd)
+    try:
+        subprocess.run(argv[:1] + ['-c', IMPORT_TIMER, out] + argv[1:], env=environment(port, pycache), cwd=ROOT,
+                       input=stdin(command), stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                       universal_newlines=True, timeout=30)
+        with open(out) as f:
+            loaded = json.load(f)
+    except ValueError:
+        loaded = {}
+    finally:
+        os.unlink(out)
+    times = {}
+    total = 0
+    for name, (own, cumulative, top_level) in loaded.items():
+        if name == 'bxcli' or name.startswith('bxcli.'):
+            times[name] = (own, cumulative)
+            if top_level:
+                total += cumulative
+    return times, total
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 1)
+
+
+@click.command()
+@click.option('--runs', '-n', type=click.IntRange(1), default=10, help='Warm runs per command, default to 10')
+@click.option('--cold-runs', type=click.IntRange(0), default=3, help='Cold runs per command, default to 3')
+@click.option('--command', '-c', 'commands', multiple=True, help='Command line to measure, repeat for several, default to a set of common ones')
+@click.option('--budget', type=float, help='Fail when the warm median time to first byte of a command exceeds this many ms')
+@click.option('--cold-budget', type=float, help='Fail when the cold median time to first byte of a command exceeds this many ms')
+@click.option('--import-budget', type=float, help='Fail when importing bxcli takes more than this many ms in a command')
+@click.option('--json', 'as_json', is_flag=True, help='Print results as JSON')
+def startup(runs, cold_runs, commands, budget, cold_budget, import_budget, as_json):
+    """Measure how long boxes takes to put its first byte on the wire
+
+    Each command runs against a local listener that timestamps the first byte
+    it receives. Cold runs start with an empty bytecode cache, warm runs share
+    a cache filled beforehand. Commands that never connect are measured until
+    they exit. The import time of every bxcli module, including the commands
+    and service modules loaded lazily, is taken from one more run. The exit
+    code is 1 when a budget is exceeded.
+    """
+    listener = FirstByteListener()
+    warm_cache = tempfile.mkdtemp(prefix='bxcli-bench-')
+    results = []
+    try:
+        for command in commands or COMMANDS:
+            argv = [sys.executable, os.path.join(ROOT, 'bin.py')] + command.split()
+            cold = []
+            for _ in range(cold_runs):
+                cold.append(run_once(argv, listener, tempfile.mkdtemp(prefix='bxcli-bench-cold-'), command))
+            run_once(argv, listener, warm_cache, command)
+            warm = [run_once(argv, listener, warm_cache, command) for _ in range(runs)]
+            imports, imports_total = import_times(argv, listener.port, warm_cache, command)
+            results.append({
+                'command': command,
+                'connects': warm[0][0] is not None,
+                'cold_ms': median_ms(cold),
+                'warm_ms': median_ms(warm),
+                'warm_min_ms': ms(min(first if first is not None else exited for first, exited in warm)),
+                'import_ms': ms(imports_total / 1e6),
+                'imports_us': dict(sorted(imports.items(), key=lambda i: -i[1][0])),
+            })
+    finally:
+        listener.close()
+
+    failures = []
+    for r in results:
+        if budget is not None and r['warm_ms'] > budget:
+            failures.append('{}: warm {}ms over budget of {}ms'.format(r['command'], r['warm_ms'], budget))
+        if cold_budget is not None and r['cold_ms'] is not None and r['cold_ms'] > cold_budget:
+            failures.append('{}: cold {}ms over budget of {}ms'.format(r['command'], r['cold_ms'], cold_budget))
+        if import_budget is not None and r['import_ms'] > import_budget:
+            failures.append('{}: imports {}ms over budget of {}ms'.format(r['command'], r['import_ms'], import_budget))
+
+    if as_json:
+        print(json.dumps({'results': results, 'failures': failures}, indent=2))
+    else:
+        report(results)
+    for failure in failures:
+        click.echo('Over budget: ' + failure, err=True)
+    sys.exit(1 if failures else 0)
+
+
+def median_ms(samples):
+    if not samples:
+        return None
+    return ms(statistics.median(first if first is not None else exited for first, exited in samples))
+
+
+def report(results):
+    print('{:<36} {:>9} {:>9} {:>9} {:>10}'.format('command', 'cold ms', 'warm ms', 'min ms', 'import ms'))
+    for r in results:
+        name = r['command'] if r['connects'] else r['command'] + ' (exit)'
+        print('{:<36} {:>9} {:>9} {:>9} {:>10}'.format(name, _text(r['cold_ms']), r['warm_ms'],
+                                                       r['warm_min_ms'], r['import_ms']))
+    print()
+    print('bxcli import time per module, self / cumulative ms, slowest first')
+    for r in results:
+        print(r['command'])
+        for name, (own, cumulative) in r['imports_us'].items():
+            print('  {:<40} {:>7.1f} {:>7.1f}'.format(name, own / 1000, cumulative / 1000))
+
+
+def _text(value):
+    return '-' if value is None else str(value)
+
+
+if __name__ == '__main__':
+    startup()
@@ -1,3 +1,3 @@
-from bxcli.bxcli import bxcli
+from bxcli.main import main
 
-bxcli()
+main()
@@ -0,0 +1,221 @@
+import io
+import json
+import os
+import socket
+import struct
+import sys
+
+from . import config
+
+# Only the standard library is imported at module level: forward() runs before
+# click, thrift and the generated service modules are loaded.
+
+# commands that always run in the invoking process
+LOCAL_COMMANDS = {'agent', 'shell', 'batch'}
+
+
+def _send(stream, message):
+    stream.write(json.dumps(message).encode('utf-8') + b'\n')
+    stream.flush()
+
+
+def _receive(stream):
+    line = stream.readline()
+    if not line:
+        raise EOFError('agent connection closed')
+    return json.loads(line.decode('utf-8'))
+
+
+def _owned(sock, path):
+    """_owned tells whether the agent listening on sock runs as the current user"""
+    if hasattr(socket, 'SO_PEERCRED'):
+        creds = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+        _, uid, _ = struct.unpack('3i', creds)
+        return uid == os.getuid()
+    return os.stat(path).st_uid == os.getuid()
+
+
+def connect():
+    """connect dials the local agent, returns None when no agent of the current user is listening"""
+    try:
+        path = config.agent_socket()
+    except ValueError:
+        # bad server settings are reported by the command run in this process
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        # the socket may be in a shared directory like /tmp, where anyone can listen first
+        if not _owned(sock, path):
+            print('Warning: ignoring agent socket {} of another user'.format(path), file=sys.stderr)
+            sock.close()
+            return None
+    except OSError:
+        sock.close()
+        return None
+    return sock
+
+
+def forward(args):
+    """forward runs a command line on the local agent
+
+    It returns the exit code of the command, or None when no agent is running
+    and the command has to be executed in this process.
+    """
+    if not config.agent_enabled() or not args or args[0] in LOCAL_COMMANDS:
+        return None
+    # group options may select other servers than the agent is connected to
+    if args[0].startswith('-'):
+        return None
+    sock = connect()
+    if sock is None:
+        return None
+
+    with sock, sock.makefile('rwb') as stream:
+        _send(stream, {'argv': args, 'cwd': os.getcwd(), 'env': config.environment()})
+        while True:
+            try:
+                message = _receive(stream)
+            except (OSError, EOFError, ValueError) as e:
+                print('Error: lost connection to agent: {}'.format(e), file=sys.stderr)
+                return 1
+            try:
+                if 'out' in message:
+                    sys.stdout.write(message['out'])
+                    sys.stdout.flush()
+                elif 'err' in message:
+                    sys.stderr.write(message['err'])
+                    sys.stderr.flush()
+            except BrokenPipeError:
+                # the reader went away, as with | head, the agent stops the command when the socket closes
+                _discard_output()
+                return 1
+            if 'read' in message:
+                _send(stream, {'line': sys.stdin.readline()})
+            elif 'exit' in message:
+                return message['exit']
+
+
+def _discard_output():
+    """_discard_output points stdout and stderr at devnull, so flushing them at exit does not fail again"""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    for stream in (sys.stdout, sys.stderr):
+        os.dup2(devnull, stream.fileno())
+    os.close(devnull)
+
+
+def request(message):
+    """request sends a control message to the agent and returns its reply, or None when no agent is running"""
+    sock = connect()
+    if sock is None:
+        return None
+    with sock, sock.makefile('rwb') as stream:
+        _send(stream, message)
+        return _receive(stream)
+
+
+class _Output(io.TextIOBase):
+    """_Output relays writes of a forwarded command back to the client"""
+
+    def __init__(self, stream, kind):
+        self.stream = stream
+        self.kind = kind
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        if isinstance(s, bytes):
+            s = s.decode('utf-8', 'replace')
+        if s:
+            _send(self.stream, {self.kind: s})
+        return len(s)
+
+
+class _Input(io.TextIOBase):
+    """_Input asks the client for a line of its stdin whenever a forwarded command reads one"""
+
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+
+    def readable(self):
+        return True
+
+    def readline(self, size=-1):
+        _send(self.wfile, {'read': True})
+        return _receive(self.rfile).get('line', '')
+
+
+def serve(group):
+    """serve answers forwarded command lines on the agent socket until asked to stop
+
+    Commands run one at a time in this process over a single long-lived
+    Session, which is reopened after a command fails.
+    """
+    import socketserver
+    from contextlib import redirect_stdout, redirect_stderr
+
+    from .util import Runner
+
+    class Handler(socketserver.StreamRequestHandler):
+
+        def handle(self):
+            message = _receive(self.rfile)
+            if message.get('stop'):
+                self.server.stopping = True
+                _send(self.wfile, {'pid': os.getpid()})
+                return
+            if message.get('status'):
+                _send(self.wfile, {'pid': os.getpid(), 'connected': self.server.runner.session is not None})
+                return
+
+            stdin, sys.stdin = sys.stdin, _Input(self.rfile, self.wfile)
+            try:
+                os.chdir(message['cwd'])
+                # settings come from the environment of the client, not the one the agent was started in
+                with config.scoped_environment(message.get('env', {})), \
+                        redirect_stdout(_Output(self.wfile, 'out')), redirect_stderr(_Output(self.wfile, 'err')):
+                    code = self.server.runner.run(message['argv'])
+            finally:
+                sys.stdin = stdin
+            _send(self.wfile, {'exit': code})
+
+    class Server(socketserver.UnixStreamServer):
+
+        def __init__(self, path):
+            self.runner = Runner(group)
+            self.stopping = False
+            super(Server, self).__init__(path, Handler)
+
+    path = config.agent_socket()
+    if os.path.exists(path):
+        os.unlink(path)
+    # the socket is created private, never readable by others even for a moment
+    umask = os.umask(0o077)
+    try:
+        server = Server(path)
+    finally:
+        os.umask(umask)
+    os.chmod(path, 0o600)
+    try:
+        while not server.stopping:
+            server.handle_request()
+    finally:
+        server.runner.close()
+        server.server_close()
+        os.unlink(path)
+
+
+def daemonize():
+    """daemonize detaches the process, returns True in the detached child and False in the caller"""
+    if os.fork() > 0:
+        return False
+    os.setsid()
+    if os.fork() > 0:
+        os._exit(0)
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in range(3):
+        os.dup2(devnull, fd)
+    os.close(devnull)
+    return True
@@ -1,35 +1,107 @@
 #! /usr/bin/env python3
+import importlib
+
 import click
 
-from .commands import box
-from .commands import file
-from .commands import link
+from . import config
+from .main import main
 
 VERSION = '1.0'
 
-@click.group()
+
+class LazyGroup(click.Group):
+    """LazyGroup imports the module of a command only when the command is looked up
+
+    lazy_commands maps command names to 'module:attribute' paths relative to
+    the bxcli package, so parsing group options or listing command names
+    imports neither the commands nor the generated service modules.
+    """
+
+    def __init__(self, *args, lazy_commands=None, **kwargs):
+        super(LazyGroup, self).__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+
+    def list_commands(self, ctx):
+        return sorted(set(self.commands) | set(self.lazy_commands))
+
+    def get_command(self, ctx, name):
+        if name not in self.commands and name in self.lazy_commands:
+            module, attribute = self.lazy_commands[name].split(':')
+            self.add_command(getattr(importlib.import_module(module, __package__), attribute), name)
+        return self.commands.get(name)
+
+
+COMMANDS = {
+    'create': '.commands.box:create',
+    'remove': '.commands.box:remove',
+    'set-name': '.commands.box:set_name',
+    'set-description': '.commands.box:set_description',
+    'archive': '.commands.box:archive',
+    'unarchive': '.commands.box:unarchive',
+    'list': '.commands.box:list',
+    'inspect': '.commands.box:inspect',
+
+    'add': '.commands.file:add',
+    'fetch': '.commands.file:fetch',
+    'rm': '.commands.file:rm',
+    'ls': '.commands.file:ls',
+    'find': '.commands.file:find',
+    'copy': '.commands.file:copy',
+    'move': '.commands.file:move',
+
+    'link': '.commands.link:link',
+    'ls-link': '.commands.link:ls_link',
+    'rm-link': '.commands.link:rm_link',
+    'check-links': '.commands.link:check_links',
+    'reconcile-links': '.commands.link:reconcile_links',
+
+    'agent': '.commands.agent:agent',
+    'shell': '.commands.shell:shell',
+    'batch': '.commands.batch:batch',
+}
+
+
+@click.group(cls=LazyGroup, lazy_commands=COMMANDS)
 @click.version_option(VERSION)
-def bxcli():
-    """Command line based client for Boxes"""
-    pass
-
-
-bxcli.add_command(box.create)
-bxcli.add_command(box.remove)
-bxcli.add_command(box.set_name)
-bxcli.add_command(box.set_description)
-bxcli.add_command(box.archive)
-bxcli.add_command(box.unarchive)
-bxcli.add_command(box.list)
-bxcli.add_command(box.inspect)
-
-bxcli.add_command(file.add)
-bxcli.add_command(file.fetch)
-bxcli.add_command(file.rm)
-bxcli.add_command(file.ls)
-bxcli.add_command(file.copy)
-bxcli.add_command(file.move)
-
-bxcli.add_command(link.link)
-bxcli.add_command(link.ls_link)
-bxcli.add_command(link.rm_link)
+@click.option('--host', '-H', help='Server host, default to localhost')
+@click.option('--port', '-P', type=int, help='Server port, default to 6077')
+@click.option('--socket', '-S', help='Connect to the server unix socket at this path')
+@click.option('--endpoint', '-E', multiple=True, help='Server endpoint, host:port or unix:path, repeat to fail over in order')
+@click.option('--no-cache', is_flag=True, default=None, help='Bypass cached server data')
+@click.option('--debug', is_flag=True, default=None, help='Print diagnostic messages to stderr')
+@click.option('--trace', is_flag=True, default=None, help='Print the time and bytes of every call to stderr')
+@click.option('--trace-file', type=click.Path(dir_okay=False), help='Write a Chrome trace of the calls to this file')
+@click.pass_context
+def bxcli(ctx, host, port, socket, endpoint, no_cache, debug, trace, trace_file):
+    """Command line based client for Boxes
+
+    Settings are read from options, then BXCLI_<NAME> environment variables,
+    then the [bxcli] section of $XDG_CONFIG_HOME/bxcli/config.ini.
+    """
+    config.override('host', host)
+    config.override('port', port)
+    config.override('socket', socket)
+    config.override('endpoints', ','.join(endpoint) or None)
+    config.override('cache', False if no_cache else None)
+    config.override('debug', debug or None)
+    config.override('trace', trace or None)
+    config.override('trace_file', trace_file)
+    if config.tracing():
+        start_trace(ctx)
+
+
+def start_trace(ctx):
+    """start_trace traces the calls of the invoked command, unless they are already traced for an outer command"""
+    from . import trace as bxtrace
+    from .tfclient import matching_session
+
+    if bxtrace.current() is not None:
+        return
+    summary, path = config.trace(), config.trace_file()
+    bxtrace.start('boxes {}'.format(ctx.invoked_subcommand or ''))
+    ctx.call_on_close(lambda: bxtrace.finish(summary, path))
+    # a connection kept by shell, batch or the agent may have been opened without tracing
+    session = matching_session()
+    if session is not None and not session.traced:
+        session.reopen()
+
@@ -0,0 +1,504 @@
+import collections
+import os
+import posixpath
+import sqlite3
+import threading
+import time
+
+from thrift.TSerialization import serialize, deserialize
+from thrift.protocol import TBinaryProtocol
+
+from . import config
+from .tf.boxes.ttypes import Box, FetchBy, Link
+from .util import debug
+
+_codec = TBinaryProtocol.TBinaryProtocolAcceleratedFactory()
+
+
+def server_key():
+    """server_key identifies the configured servers, caches of different servers are kept apart"""
+    return ','.join(str(e) for e in config.endpoints())
+
+
+class BoxCache(object):
+    """BoxCache keeps Box structs in a SQLite file under the cache dir
+
+    Boxes are keyed by server and id. A box, and the whole listing returned by
+    currentBoxes, are valid for cache_ttl seconds after they were fetched.
+    """
+
+    def __init__(self, path=None, server=None, ttl=None):
+        self.path = path or os.path.join(config.cache_dir(), 'boxes.sqlite')
+        self.server = server or server_key()
+        self.ttl = config.cache_ttl() if ttl is None else ttl
+        self._db = None
+
+    def db(self):
+        if self._db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=5)
+            db.execute('CREATE TABLE IF NOT EXISTS boxes '
+                       '(server TEXT, id INTEGER, data BLOB, fetched REAL, PRIMARY KEY (server, id))')
+            db.execute('CREATE TABLE IF NOT EXISTS listings (server TEXT PRIMARY KEY, fetched REAL)')
+            self._db = db
+        return self._db
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def get(self, id):
+        """get returns the cached box, None when missing or expired"""
+        row = self.db().execute('SELECT data FROM boxes WHERE server = ? AND id = ? AND fetched > ?',
+                                (self.server, id, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        return deserialize(Box(), row[0], _codec)
+
+    def put(self, box):
+        with self.db() as db:
+            db.execute('INSERT OR REPLACE INTO boxes VALUES (?, ?, ?, ?)',
+                       (self.server, box.id, serialize(box, _codec), time.time()))
+
+    def all(self):
+        """all returns the cached listing of boxes, None when missing or expired"""
+        db = self.db()
+        row = db.execute('SELECT fetched FROM listings WHERE server = ? AND fetched > ?',
+                         (self.server, time.time() - self.ttl)).fetchone()
+        if row is None:
+            return None
+        rows = db.execute('SELECT data FROM boxes WHERE server = ? ORDER BY id', (self.server,))
+        return [deserialize(Box(), data, _codec) for data, in rows]
+
+    def put_all(self, boxes):
+        now = time.time()
+        with self.db() as db:
+            db.execute('DELETE FROM boxes WHERE server = ?', (self.server,))
+            db.executemany('INSERT INTO boxes VALUES (?, ?, ?, ?)',
+                           [(self.server, b.id, serialize(b, _codec), now) for b in boxes])
+            db.execute('INSERT OR REPLACE INTO listings VALUES (?, ?)', (self.server, now))
+
+    def invalidate(self, id=None):
+        """invalidate drops the listing, and the box with id unless id is None"""
+        with self.db() as db:
+            db.execute('DELETE FROM listings WHERE server = ?', (self.server,))
+            if id is not None:
+                db.execute('DELETE FROM boxes WHERE server = ? AND id = ?', (self.server, id))
+
+
+class LsCache(object):
+    """LsCache keeps FileService.ls results in memory, least recently used first out
+
+    Listings are keyed by server, box id and inner dir, expire after ttl
+    seconds, and are evicted once the listings kept hold more than size
+    entries in total. It is shared by every thread of the process.
+    """
+
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.entries = 0
+        self.listings = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """get returns the cached listing, None when missing or expired"""
+        with self.lock:
+            cached = self.listings.get(key)
+            if cached is None:
+                return None
+            fetched, items = cached
+            if fetched <= time.time() - self.ttl:
+                self._drop(key)
+                return None
+            self.listings.move_to_end(key)
+            return items
+
+    def put(self, key, items):
+        if len(items) > self.size:
+            return
+        with self.lock:
+            self._drop(key)
+            self.listings[key] = (time.time(), items)
+            self.entries += len(items)
+            while self.entries > self.size:
+                self._drop(next(iter(self.listings)))
+
+    def invalidate(self, server, box_id, path):
+        """invalidate drops the listings of path, of everything under it and of its parent"""
+        path = normalize(path)
+        parent = posixpath.dirname(path)
+        prefix = path.rstrip('/') + '/'
+        with self.lock:
+            for key in [k for k in self.listings if k[0] == server and k[1] == box_id]:
+                if key[2] == path or key[2] == parent or key[2].startswith(prefix):
+                    self._drop(key)
+
+    def _drop(self, key):
+        cached = self.listings.pop(key, None)
+        if cached is not None:
+            self.entries -= len(cached[1])
+
+
+_ls_cache = None
+_ls_cache_lock = threading.Lock()
+
+
+def ls_cache():
+    """ls_cache returns the LsCache of the process"""
+    global _ls_cache
+    with _ls_cache_lock:
+        if _ls_cache is None:
+            _ls_cache = LsCache(config.ls_cache_size(), config.ls_cache_ttl())
+        return _ls_cache
+
+
+def normalize(path):
+    """normalize turns an inner path into the form listings are keyed by"""
+    return posixpath.normpath('/' + path.lstrip('/'))
+
+
+class LinkIndex(object):
+    """LinkIndex keeps the links of the server in SQLite to look them up by prefix
+
+    Links are held per box along with when the box was listed, in a SQLite
+    file under the cache dir. Lookups are range scans of its indexes, by
+    destination or by box id and normalized inner path, so they answer without
+    reading the whole table. A box listed more than ttl seconds ago, or
+    invalidated, is stale until its links are put again. Changes made by other
+    processes are read back on next use.
+    """
+
+    # bumped when the tables change, the links are listed again then
+    SCHEMA = 1
+
+    def __init__(self, path=None, server=None, ttl=None):
+        self.path = path or os.path.join(config.cache_dir(), 'links.sqlite')
+        self.server = server or server_key()
+        self.ttl = config.link_index_ttl() if ttl is None else ttl
+        self.lock = threading.RLock()
+        # when every indexed box was listed
+        self.boxes = {}
+        self._db = None
+        self._version = None
+
+    def db(self):
+        if self._db is None:
+            if self.path != ':memory:':
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            db = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+            with db:
+                if db.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA:
+                    db.execute('DROP TABLE IF EXISTS links')
+                    db.execute('DROP TABLE IF EXISTS indexed_boxes')
+                    db.execute('PRAGMA user_version = {}'.format(self.SCHEMA))
+                db.execute('CREATE TABLE IF NOT EXISTS links (server TEXT, box_id INTEGER, inner_path TEXT, '
+                           'path TEXT, destination TEXT, type INTEGER)')
+                db.execute('CREATE INDEX IF NOT EXISTS links_path ON links (server, box_id, path)')
+                db.execute('CREATE INDEX IF NOT EXISTS links_destination ON links (server, destination)')
+                db.execute('CREATE TABLE IF NOT EXISTS indexed_boxes '
+                           '(server TEXT, box_id INTEGER, fetched REAL, PRIMARY KEY (server, box_id))')
+            self._db = db
+        return self._db
+
+    def close(self):
+        with self.lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+                self._version = None
+
+    def _load(self):
+        # data_version only changes when another connection committed
+        db = self.db()
+        version = db.execute('PRAGMA data_version').fetchone()[0]
+        if version == self._version:
+            return
+        self.boxes = dict(db.execute('SELECT box_id, fetched FROM indexed_boxes WHERE server = ?', (self.server,)))
+        self._version = version
+
+    def empty(self):
+        """empty tells whether no box has been indexed yet"""
+        with self.lock:
+            self._load()
+            return not self.boxes
+
+    def stale(self, box_ids):
+        """stale returns the ids among box_ids whose links are missing or expired"""
+        with self.lock:
+            self._load()
+            expired = time.time() - self.ttl
+            return [i for i in box_ids if self.boxes.get(i, 0) <= expired]
+
+    def put(self, links, box_ids, replace_all=False):
+        """put stores the links listed for box_ids, every other box is dropped when replace_all is set"""
+        by_box = dict((i, []) for i in box_ids)
+        for l in links:
+            by_box.setdefault(l.boxId, []).append(l)
+        now = time.time()
+        with self.lock:
+            self._load()
+            with self.db() as db:
+                if replace_all:
+                    db.execute('DELETE FROM links WHERE server = ?', (self.server,))
+                    db.execute('DELETE FROM indexed_boxes WHERE server = ?', (self.server,))
+                    self.boxes = {}
+                for box_id, box_links in by_box.items():
+                    if not replace_all:
+                        db.execute('DELETE FROM links WHERE server = ? AND box_id = ?', (self.server, box_id))
+                    db.executemany('INSERT INTO links VALUES (?, ?, ?, ?, ?, ?)',
+                                   [(self.server, box_id, l.innerPath, normalize(l.innerPath), l.destination, l.type)
+                                    for l in box_links])
+                    db.execute('INSERT OR REPLACE INTO indexed_boxes VALUES (?, ?, ?)', (self.server, box_id, now))
+                    self.boxes[box_id] = now
+
+    def indexed(self):
+        """indexed returns the ids of the boxes whose links are held"""
+        with self.lock:
+            self._load()
+            return list(self.boxes)
+
+    def drop(self, box_ids):
+        """drop forgets the links of box_ids"""
+        with self.lock:
+            self._load()
+            with self.db() as db:
+                for box_id in box_ids:
+                    db.execute('DELETE FROM links WHERE server = ? AND box_id = ?', (self.server, box_id))
+                    db.execute('DELETE FROM indexed_boxes WHERE server = ? AND box_id = ?', (self.server, box_id))
+                    self.boxes.pop(box_id, None)
+
+    def invalidate(self, box_id=None):
+        """invalidate makes the links of a box stale, of every box when box_id is None"""
+        with self.lock:
+            with self.db() as db:
+                if box_id is None:
+                    db.execute('UPDATE indexed_boxes SET fetched = 0 WHERE server = ?', (self.server,))
+                else:
+                    db.execute('UPDATE indexed_boxes SET fetched = 0 WHERE server = ? AND box_id = ?',
+                               (self.server, box_id))
+            for i in self.boxes:
+                if box_id is None or i == box_id:
+                    self.boxes[i] = 0
+
+    def invalidate_destination(self, destination):
+        """invalidate_destination makes stale the boxes holding a link at destination"""
+        with self.lock:
+            rows = self.db().execute('SELECT DISTINCT box_id FROM links WHERE server = ? AND destination = ?',
+                                     (self.server, destination)).fetchall()
+            for box_id, in rows:
+                self.invalidate(box_id)
+
+    def _links(self, where, args, order):
+        with self.lock:
+            rows = self.db().execute('SELECT box_id, inner_path, destination, type FROM links '
+                                     'WHERE server = ? AND ' + where + ' ORDER BY ' + order, (self.server,) + args)
+            return [Link(box_id, inner_path, destination, type) for box_id, inner_path, destination, type in rows]
+
+    def by_destination(self, prefix):
+        """by_destination returns the links whose destination starts with prefix, sorted by destination"""
+        order = 'destination, box_id, inner_path'
+        end = _successor(prefix)
+        if end is None:
+            return self._links('destination >= ?', (prefix,), order)
+        return self._links('destination >= ? AND destination < ?', (prefix, end), order)
+
+    def by_inner(self, box_id, inner_path='/'):
+        """by_inner returns the links of inner_path and of everything under it, sorted by inner path"""
+        path = normalize(inner_path)
+        if path == '/':
+            return self._links('box_id = ?', (box_id,), 'path, destination')
+        # path and the paths under it sort before path + '0', '0' being the character after '/'
+        return self._links('box_id = ? AND path >= ? AND path < ? AND (path = ? OR path >= ?)',
+                           (box_id, path, path + '0', path, path + '/'), 'path, destination')
+
+
+def _successor(prefix):
+    """_successor returns the first string after every string starting with prefix, None when there is none"""
+    prefix = prefix.rstrip('\U0010ffff')
+    if prefix == '':
+        return None
+    last = ord(prefix[-1]) + 1
+    if 0xd800 <= last < 0xe000:
+        # surrogates cannot be stored, the next storable character follows them
+        last = 0xe000
+    return prefix[:-1] + chr(last)
+
+
+_link_indexes = {}
+_link_indexes_lock = threading.Lock()
+
+
+def link_index():
+    """link_index returns the LinkIndex of the configured servers, kept for the life of the process"""
+    server = server_key()
+    with _link_indexes_lock:
+        if server not in _link_indexes:
+            _link_indexes[server] = LinkIndex(server=server)
+        return _link_indexes[server]
+
+
+class CachingClient(object):
+    """CachingClient wraps a generated service client, answering reads from a cache
+
+    Calls are delegated to the wrapped client; mutating calls invalidate what
+    they change once they succeed, through completed. Cache failures are
+    reported in debug output and fall back to the server.
+    """
+
+    def __init__(self, client, cache):
+        self.client = client
+        self.cache = cache
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _cached(self, lookup, *args):
+        try:
+            return lookup(*args)
+        except (sqlite3.Error, OSError) as e:
+            debug('cache: {}'.format(e))
+            return None
+
+    def _call(self, method, *args):
+        result = getattr(self.client, method)(*args)
+        self.completed(method, args)
+        return result
+
+    def completed(self, method, args):
+        """completed invalidates what a successful call of method with args changed"""
+        pass
+
+    def close(self):
+        pass
+
+
+class CachingBoxClient(CachingClient):
+    """CachingBoxClient answers currentBoxes and get of a BoxService client from a BoxCache"""
+
+    def currentBoxes(self):
+        boxes = self._cached(self.cache.all)
+        if boxes is None:
+            boxes = self.client.currentBoxes()
+            self._cached(self.cache.put_all, boxes)
+        return boxes
+
+    def get(self, id):
+        box = self._cached(self.cache.get, id)
+        if box is None:
+            box = self.client.get(id)
+            self._cached(self.cache.put, box)
+        return box
+
+    def create(self, name, description):
+        return self._call('create', name, description)
+
+    def remove(self, id):
+        return self._call('remove', id)
+
+    def setDescription(self, id, description):
+        return self._call('setDescription', id, description)
+
+    def setName(self, id, name):
+        return self._call('setName', id, name)
+
+    def archive(self, id):
+        return self._call('archive', id)
+
+    def unarchive(self, id):
+        return self._call('unarchive', id)
+
+    def completed(self, method, args):
+        if method == 'create':
+            self._cached(self.cache.invalidate, None)
+        elif method in ('remove', 'setDescription', 'setName', 'archive', 'unarchive'):
+            self._cached(self.cache.invalidate, args[0])
+
+    def close(self):
+        self.cache.close()
+
+
+class CachingFileClient(CachingClient):
+    """CachingFileClient answers ls of a FileService client from the LsCache of the process"""
+
+    def __init__(self, client, cache):
+        super(CachingFileClient, self).__init__(client, cache)
+        self.server = server_key()
+
+    def ls(self, boxId, innerDir):
+        key = (self.server, boxId, normalize(innerDir))
+        items = self.cache.get(key)
+        if items is None:
+            items = self.client.ls(boxId, innerDir)
+            self.cache.put(key, items)
+        return items
+
+    def add(self, boxId, innerPath, outerPath, addBy):
+        return self._call('add', boxId, innerPath, outerPath, addBy)
+
+    def fetch(self, boxId, innerPath, outerPath, fetchBy):
+        return self._call('fetch', boxId, innerPath, outerPath, fetchBy)
+
+    def remove(self, boxId, innerPath):
+        return self._call('remove', boxId, innerPath)
+
+    def move(self, srcBoxId, srcInnerPath, dstBoxId, dstInnerPath):
+        return self._call('move', srcBoxId, srcInnerPath, dstBoxId, dstInnerPath)
+
+    def copy(self, srcBoxId, srcInnerPath, dstBoxId, dstInnerPath):
+        return self._call('copy', srcBoxId, srcInnerPath, dstBoxId, dstInnerPath)
+
+    def innerMove(self, boxId, srcInnerPath, dstInnerPath):
+        return self._call('innerMove', boxId, srcInnerPath, dstInnerPath)
+
+    def innerCopy(self, boxId, srcInnerPath, dstInnerPath):
+        return self._call('innerCopy', boxId, srcInnerPath, dstInnerPath)
+
+    def completed(self, method, args):
+        changed = []
+        if method in ('add', 'remove'):
+            changed = [(args[0], args[1])]
+        elif method == 'fetch' and args[3] == FetchBy.MOVE:
+            changed = [(args[0], args[1])]
+        elif method == 'move':
+            changed = [(args[0], args[1]), (args[2], args[3])]
+        elif method == 'copy':
+            changed = [(args[2], args[3])]
+        elif method == 'innerMove':
+            changed = [(args[0], args[1]), (args[0], args[2])]
+        elif method == 'innerCopy':
+            changed = [(args[0], args[2])]
+        for box_id, path in changed:
+            self.cache.invalidate(self.server, box_id, path)
+
+
+class CachingLinkClient(CachingClient):
+    """CachingLinkClient makes stale the boxes of a LinkIndex whose links a LinkService client changed"""
+
+    def create(self, boxId, innerPath, destination, linkType):
+        return self._call('create', boxId, innerPath, destination, linkType)
+
+    def removeAll(self):
+        return self._call('removeAll')
+
+    def removeById(self, id):
+        return self._call('removeById', id)
+
+    def removeByBox(self, boxId):
+        return self._call('removeByBox', boxId)
+
+    def removeByInner(self, boxId, innerPath):
+        return self._call('removeByInner', boxId, innerPath)
+
+    def removeByDestination(self, destination):
+        return self._call('removeByDestination', destination)
+
+    def completed(self, method, args):
+        if method in ('create', 'removeByBox', 'removeByInner'):
+            self._cached(self.cache.invalidate, args[0])
+        elif method in ('removeAll', 'removeById'):
+            # links have no box known by id on the client side
+            self._cached(self.cache.invalidate, None)
+        elif method == 'removeByDestination':
+            self._cached(self.cache.invalidate_destination, args[0])
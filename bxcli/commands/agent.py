@@ -0,0 +1,66 @@
+import click
+import os
+import time
+
+from .. import agent as bxagent
+from ..config import agent_socket
+from ..util import report_err
+
+
+@click.group(name='agent', short_help='manage the local connection agent')
+def agent():
+    """Manage the local agent that keeps a warm connection to Boxes
+
+    While the agent is running, boxes forwards every command to it over a unix
+    socket instead of connecting to the server itself. Set BXCLI_NO_AGENT=1 to
+    bypass a running agent.
+    """
+    pass
+
+
+@agent.command(name='start', short_help='start the agent')
+@click.option('--foreground', '-f', is_flag=True, help='Run in foreground instead of detaching')
+def start(foreground):
+    """Start the local agent"""
+    if bxagent.request({'status': True}) is not None:
+        report_err('agent is already running at {}'.format(agent_socket()))
+        return
+    group = click.get_current_context().find_root().command
+    if foreground:
+        bxagent.serve(group)
+        return
+
+    if bxagent.daemonize():
+        try:
+            bxagent.serve(group)
+        finally:
+            os._exit(0)
+
+    for _ in range(50):
+        reply = bxagent.request({'status': True})
+        if reply is not None:
+            print('Agent started with pid {}'.format(reply['pid']))
+            return
+        time.sleep(0.1)
+    report_err('agent did not come up at {}'.format(agent_socket()))
+
+
+@agent.command(name='stop', short_help='stop the agent')
+def stop():
+    """Stop the local agent"""
+    reply = bxagent.request({'stop': True})
+    if reply is None:
+        print('Agent is not running')
+        return
+    print('Agent with pid {} stopped'.format(reply['pid']))
+
+
+@agent.command(name='status', short_help='show agent status')
+def status():
+    """Show whether the local agent is running"""
+    reply = bxagent.request({'status': True})
+    if reply is None:
+        print('Agent is not running')
+        return
+    state = 'connected' if reply['connected'] else 'idle'
+    print('Agent running with pid {} at {} ({})'.format(reply['pid'], agent_socket(), state))
@@ -0,0 +1,70 @@
+import click
+import shlex
+import sys
+
+from ..util import Runner, assume_answer, declined, report_err
+
+UNAVAILABLE_COMMANDS = {'batch', 'shell', 'agent'}
+
+
+@click.command(name='batch', short_help='run commands from a file')
+@click.option('--file', '-f', 'ops', type=click.File('r'), default='-', help='File with one command per line, - for stdin')
+@click.option('--yes', '-y', is_flag=True, help='Confirm every operation without asking')
+@click.option('--stop-on-error', is_flag=True, help='Stop at the first failed line')
+def batch(ops, yes, stop_on_error):
+    """Run commands, one per line, over a single connection
+
+    Each line uses the syntax of the command line, e.g. 'add 3:/a ./x'. Empty
+    lines and lines starting with # are skipped. Without --yes, confirmations
+    are asked on the terminal, or declined when commands are read from stdin.
+    The result of every line is reported on stderr, lines whose operation was
+    not confirmed are skipped. The exit code is 1 when a line failed or was
+    skipped.
+    """
+    group = click.get_current_context().find_root().command
+    if yes:
+        answer = True
+    elif ops.name == '<stdin>':
+        answer = False
+    else:
+        answer = None
+
+    runner = Runner(group)
+    succeeded, skipped, failed = 0, 0, 0
+    try:
+        with assume_answer(answer):
+            for lineno, line in enumerate(ops, 1):
+                line = line.strip()
+                if line == '' or line.startswith('#'):
+                    continue
+                try:
+                    args = shlex.split(line)
+                    if args[0] == 'boxes':
+                        args = args[1:]
+                    if args[0] in UNAVAILABLE_COMMANDS:
+                        raise ValueError('{} is not available in batch'.format(args[0]))
+                except (ValueError, IndexError) as e:
+                    report_err(e)
+                    code, cancelled = 1, False
+                else:
+                    cancelled = declined()
+                    code = runner.run(args)
+                    cancelled = declined() != cancelled
+
+                if code == 0 and cancelled:
+                    skipped += 1
+                    print('line {}: skipped, not confirmed: {}'.format(lineno, line), file=sys.stderr)
+                elif code == 0:
+                    succeeded += 1
+                    print('line {}: ok: {}'.format(lineno, line), file=sys.stderr)
+                else:
+                    failed += 1
+                    print('line {}: failed: {}'.format(lineno, line), file=sys.stderr)
+                    if stop_on_error:
+                        break
+    finally:
+        runner.close()
+
+    print('{} succeeded, {} skipped, {} failed'.format(succeeded, skipped, failed), file=sys.stderr)
+    if failed or skipped:
+        sys.exit(1)
@@ -1,9 +1,10 @@
 import click
-from terminaltables import AsciiTable
+import json
 
+from ..render import output_option, renderer, to_dict
 from ..tfclient import BoxServiceSession
 from ..util import ask_sure, report_exception
-from ..tf.boxes.BoxService import BoxStatus
+from ..tf.boxes.ttypes import Box, BoxStatus
 
 
 @click.command(name='create', short_help="create new box")
@@ -67,28 +68,38 @@ def unarchive(id):
 
 
 @click.command(name='list', short_help='list all boxes')
+@output_option
 @report_exception
-def list():
+def list(output):
     """List all boxes"""
     with BoxServiceSession() as client:
         boxes = client.currentBoxes()
 
-        table = [
-            ['ID', 'Name', 'Description', 'Status', 'CreatedAt']
-        ]
+    with renderer(output, ['ID', 'Name', 'Description', 'Status', 'CreatedAt'], box_cells, Box) as r:
         for b in boxes:
-            table.append([b.id, b.name, b.description, BoxStatus._VALUES_TO_NAMES[b.status], b.createdAt])
-        t = AsciiTable(table)
-        print(t.table)
+            r.record(b)
+
+
+def box_cells(b):
+    return [b.id, b.name, b.description, BoxStatus._VALUES_TO_NAMES[b.status], b.createdAt]
 
 
 @click.command(name='inspect', short_help='show detail of a box')
 @click.argument('id', type=int)
+@output_option
 @report_exception
-def inspect(id):
+def inspect(id, output):
     """Inspect the detail info of a box"""
     with BoxServiceSession() as client:
         box = client.get(id)
+    if output == 'json':
+        print(json.dumps(to_dict(box)))
+    elif output != 'table':
+        with renderer(output, ['ID', 'Name', 'Description', 'Status', 'CreatedAt'], box_cells, Box) as r:
+            r.record(box)
+    else:
+        # only this table needs terminaltables, listings are drawn by render
+        from terminaltables import AsciiTable
         table = [
             ['ID', box.id],
             ['Name', box.name],
@@ -1,79 +1,271 @@
 import click
+import collections
+import fnmatch
+import glob
 import os.path
-from terminaltables import AsciiTable
+import posixpath
+import re
 
-from ..tfclient import FileServiceSession
-from ..tf.boxes.FileService import AddBy, FetchBy, LsType
-from ..util import parse_inner_path, ask_sure, report_exception
+from ..pool import run_parallel
+from ..render import output_option, renderer
+from ..tfclient import FileServiceSession, pipelined
+from ..tf.boxes.ttypes import AddBy, FetchBy, LsItem, LsType
+from ..util import parse_inner_path, ask_sure, report_exception, report_failures, report_err, explain
+from ..walk import walk
 
 
 @click.command(name='add', short_help='add to box')
 @click.argument('inner_dst', type=str)
-@click.argument('outer_src', type=str)
+@click.argument('outer_src', type=str, nargs=-1, required=True)
 @click.option('--move/--copy', default=True, help='Add by move or copy, default to move')
+@click.option('--workers', '-w', type=click.IntRange(1), default=4, help='Number of concurrent additions, default to 4')
 @report_exception
-def add(inner_dst, outer_src, move):
-    """Add a file or dir to the specific path inside a box"""
+def add(inner_dst, outer_src, move, workers):
+    """Add files or dirs to the specific path inside a box
+
+    Sources may be glob patterns, expanded here rather than by the shell. With
+    several sources, additions run concurrently and every one is reported;
+    a failed addition does not stop the others. Sources inside another source
+    are added with it, and nothing is added when two sources have the same
+    name.
+    """
     id, inner_path = parse_inner_path(inner_dst)
-    inner_path = os.path.join(inner_path, os.path.basename(outer_src))
 
     if move:
         add_by = AddBy.MOVE
     else:
         add_by = AddBy.COPY
 
+    if len(outer_src) == 1 and not glob.has_magic(outer_src[0]):
+        outer_src = outer_src[0]
+        with FileServiceSession() as client:
+            client.add(id, os.path.join(inner_path, source_name(outer_src)), outer_src, add_by)
+        return
+
+    sources, unmatched = [], []
+    for pattern in outer_src:
+        if not glob.has_magic(pattern):
+            sources.append(pattern)
+            continue
+        matched = sorted(glob.glob(pattern, recursive=True))
+        if not matched:
+            report_err('{}: no match'.format(pattern))
+            unmatched.append(pattern)
+        sources.extend(matched)
+    sources = outermost(sources)
+
+    targets = {}
+    for src in sources:
+        targets.setdefault(source_name(src), []).append(src)
+    collisions = [(name, srcs) for name, srcs in targets.items() if len(srcs) > 1]
+    for name, srcs in collisions:
+        report_err('{} would all be added as {}:{}'.format(', '.join(srcs), id, os.path.join(inner_path, name)))
+    if collisions:
+        raise Exception('{} names added more than once, nothing added'.format(len(collisions)))
+
+    calls = [(id, os.path.join(inner_path, source_name(src)), src, add_by) for src in sources]
+    failed = run_parallel(add_one, calls, workers, lambda id, path, src, add_by: 'add {} to {}:{}'.format(src, id, path))
+    print('{} added, {} failed'.format(len(calls) - failed, failed + len(unmatched)))
+    if failed or unmatched:
+        raise Exception('{} of {} additions failed'.format(failed + len(unmatched), len(calls) + len(unmatched)))
+
+
+def add_one(id, inner_path, outer_src, add_by):
     with FileServiceSession() as client:
         client.add(id, inner_path, outer_src, add_by)
 
 
+def outermost(sources):
+    """outermost drops repeated sources and sources under another one, which is added along with them"""
+    paths = {os.path.abspath(src) for src in sources}
+    result, seen = [], set()
+    for src in sources:
+        path = os.path.abspath(src)
+        if path in seen:
+            continue
+        seen.add(path)
+        ancestor, inside = path, False
+        while not inside and os.path.dirname(ancestor) != ancestor:
+            ancestor = os.path.dirname(ancestor)
+            inside = ancestor in paths
+        if not inside:
+            result.append(src)
+    return result
+
+
+def source_name(src):
+    """source_name is the name an outer source gets inside the box, trailing separators ignored"""
+    return os.path.basename(os.path.normpath(src))
+
+
 @click.command(name='fetch', short_help='fetch from box')
-@click.argument('inner_src', type=str)
+@click.argument('inner_src', type=str, nargs=-1)
 @click.argument('outer_dst', type=str)
+@click.option('--manifest', '-m', type=click.File('r'), help='File listing inner paths to fetch, one per line, - for stdin')
 @click.option('--move/--copy', default=True, help='Fetch by move or copy, default to move')
+@click.option('--workers', '-w', type=click.IntRange(1), default=4, help='Number of concurrent fetches, default to 4')
 @report_exception
-def fetch(inner_src, outer_dst, move):
-    """Fetch file or dir from the specific box"""
-    id, inner_path = parse_inner_path(inner_src)
-    outer_dst = os.path.join(outer_dst, os.path.basename(inner_path))
+def fetch(inner_src, outer_dst, manifest, move, workers):
+    """Fetch files or dirs from boxes
+
+    Inner paths come from the arguments and from the manifest. With several
+    of them, fetches run concurrently and are reported in the order given; a
+    failed fetch does not stop the others. Nothing is fetched when two inner
+    paths have the same name.
+    """
+    inner_src = list(inner_src)
+    if manifest is not None:
+        inner_src.extend(line.strip() for line in manifest
+                         if line.strip() != '' and not line.startswith('#'))
+    if not inner_src:
+        raise Exception('no inner path to fetch')
 
     if move:
         fetch_by = FetchBy.MOVE
     else:
         fetch_by = FetchBy.COPY
 
+    calls, targets = [], collections.OrderedDict()
+    for src in inner_src:
+        id, inner_path = parse_inner_path(src)
+        dst = os.path.join(outer_dst, os.path.basename(inner_path))
+        sources = targets.setdefault(dst, [])
+        if (id, inner_path) in sources:
+            continue
+        sources.append((id, inner_path))
+        calls.append((id, inner_path, dst, fetch_by))
+    collisions = [(dst, srcs) for dst, srcs in targets.items() if len(srcs) > 1]
+    for dst, srcs in collisions:
+        report_err('{} would all be fetched to {}'.format(', '.join('{}:{}'.format(*src) for src in srcs), dst))
+    if collisions:
+        raise Exception('{} locations fetched to more than once, nothing fetched'.format(len(collisions)))
+
+    if len(calls) == 1 and manifest is None:
+        with FileServiceSession() as client:
+            client.fetch(*calls[0])
+        return
+
+    failed = run_parallel(fetch_one, calls, workers,
+                          lambda id, path, dst, fetch_by: 'fetch {}:{} to {}'.format(id, path, dst), ordered=True)
+    print('{} fetched, {} failed'.format(len(calls) - failed, failed))
+    if failed:
+        raise Exception('{} of {} fetches failed'.format(failed, len(calls)))
+
+
+def fetch_one(id, inner_path, outer_dst, fetch_by):
     with FileServiceSession() as client:
         client.fetch(id, inner_path, outer_dst, fetch_by)
 
 
 @click.command(name='rm', short_help='remove from box')
-@click.argument('inner_path', type=str)
+@click.argument('inner_path', type=str, nargs=-1, required=True)
+@click.option('--pipeline', '-p', type=click.IntRange(1), default=16, help='Number of removals kept in flight, default to 16')
 @report_exception
-def rm(inner_path):
-    """Remove a file or dir inside a box"""
-    if not ask_sure('remove {}'.format(inner_path)):
+def rm(inner_path, pipeline):
+    """Remove files or dirs inside boxes"""
+    if len(inner_path) == 1:
+        hint = 'remove {}'.format(inner_path[0])
+    else:
+        hint = 'remove {} items'.format(len(inner_path))
+    if not ask_sure(hint):
         print('Operation cancelled')
         return
-    id, path = parse_inner_path(inner_path)
+    calls = [parse_inner_path(i) for i in inner_path]
     with FileServiceSession() as client:
-        client.remove(id, path)
+        failed = report_failures(pipelined(client, 'remove', calls, pipeline),
+                                 lambda id, path: 'remove {}:{}'.format(id, path))
+    if failed:
+        raise Exception('{} of {} removals failed'.format(failed, len(calls)))
 
 
 @click.command(name='ls', short_help='list files inside a box')
 @click.argument('inner_dir')
+@click.option('--recursive', '-R', is_flag=True, help='List subdirectories recursively')
+@click.option('--workers', '-w', type=click.IntRange(1), default=8, help='Number of concurrent listings with -R, default to 8')
+@output_option
 @report_exception
-def ls(inner_dir):
+def ls(inner_dir, recursive, workers, output):
     """List all files and dirs inside a inner dir"""
     id, path = parse_inner_path(inner_dir)
+    if recursive:
+        ls_recursive(id, path, workers, output)
+        return
     with FileServiceSession() as client:
         flist = client.ls(id, path)
-    table_array = [['Type','Name']]
-    for f in flist:
-        if f.type == LsType.DIR:
-            t = 'D'
-        else:
-            t = 'F'
-        table_array.append([t, f.name])
-    print(AsciiTable(table_array).table)
+    with renderer(output, ['Type', 'Name'], lambda f: [type_letter(f), f.name], LsItem) as r:
+        for f in flist:
+            r.record(f)
+
+
+def type_letter(f):
+    if f.type == LsType.DIR:
+        return 'D'
+    return 'F'
+
+
+def ls_recursive(id, path, workers, output):
+    """print every entry under path as its listing arrives"""
+    failed = 0
+    with renderer(output, ['Type', 'Path'], lambda f, p: [type_letter(f), p], LsItem, ['path']) as r:
+        for inner_dir, _, flist, error in walk(id, path, workers):
+            if error is not None:
+                report_err('ls {}:{}: {}'.format(id, inner_dir, explain(error)))
+                failed += 1
+                continue
+            for f in flist:
+                r.record(f, '{}:{}'.format(id, posixpath.join(inner_dir, f.name)))
+    if failed:
+        raise Exception('{} directories could not be listed'.format(failed))
+
+
+@click.command(name='find', short_help='search files inside a box')
+@click.argument('inner_dir')
+@click.option('--name', '-n', help='Match entry names against a glob pattern')
+@click.option('--regex', '-r', help='Match entry names against a regular expression')
+@click.option('--type', '-t', 'ftype', type=click.Choice(['f', 'd']), help='Match only files or only dirs')
+@click.option('--prune', '-p', multiple=True, help='Do not descend into dirs whose name matches this glob, can be repeated')
+@click.option('--max-depth', '-d', type=click.IntRange(1), help='Match entries at most this many levels below INNER_DIR')
+@click.option('--max-results', '-m', type=click.IntRange(1), help='Stop after this many matches')
+@click.option('--workers', '-w', type=click.IntRange(1), default=8, help='Number of concurrent listings, default to 8')
+@report_exception
+def find(inner_dir, name, regex, ftype, prune, max_depth, max_results, workers):
+    """Find files and dirs under a inner dir by name
+
+    Directories are listed concurrently, each as soon as its parent listing
+    arrives, and matches are printed as they are found, in no particular order.
+    """
+    id, path = parse_inner_path(inner_dir)
+    pattern = re.compile(regex) if regex is not None else None
+
+    def matches(f):
+        if ftype == 'f' and f.type == LsType.DIR or ftype == 'd' and f.type != LsType.DIR:
+            return False
+        if name is not None and not fnmatch.fnmatchcase(f.name, name):
+            return False
+        if pattern is not None and pattern.search(f.name) is None:
+            return False
+        return True
+
+    def descend(inner_path, f):
+        return not any(fnmatch.fnmatchcase(f.name, p) for p in prune)
+
+    # entries of dirs listed at depth n are n + 1 levels below inner_dir
+    list_depth = max_depth - 1 if max_depth is not None else None
+    found, failed = 0, 0
+    for inner_dir, _, flist, error in walk(id, path, workers, list_depth, descend):
+        if error is not None:
+            report_err('ls {}:{}: {}'.format(id, inner_dir, explain(error)))
+            failed += 1
+            continue
+        for f in flist:
+            if not matches(f):
+                continue
+            print('{}:{}'.format(id, posixpath.join(inner_dir, f.name)))
+            found += 1
+            if max_results is not None and found >= max_results:
+                return
+    if failed:
+        raise Exception('{} directories could not be listed'.format(failed))
 
 
 @click.command(name='move', short_help='move files among boxes')
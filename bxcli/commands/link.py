@@ -1,68 +1,403 @@
 import click
+import collections
+import itertools
 import os.path
-from terminaltables import AsciiTable
+import posixpath
+import stat
 
-from ..tfclient import LinkServiceSession
-from ..tf.boxes.LinkService import LinkType
-from ..util import parse_inner_path, ask_sure, report_exception
+from .. import config
+from ..cache import LinkIndex, link_index, normalize
+from ..pool import WorkerPool
+from ..render import output_option, renderer
+from ..tfclient import BoxServiceSession, FileServiceSession, LinkServiceSession, pipelined, shared_session, stream_list, \
+    uncached
+from ..tf.boxes.ttypes import BoxStatus, Link, LinkType, ServiceException
+from ..util import parse_inner_path, ask_sure, report_exception, report_failures, report_err, explain
 
 
 @click.command(name='link', short_help='create link')
-@click.argument('inner_src', type=str)
-@click.argument('dst', type=str)
+@click.argument('inner_src', type=str, required=False)
+@click.argument('dst', type=str, required=False)
 @click.option('--soft/--hard', default=True, help='Create soft or hard link, default to soft')
+@click.option('--from', '-f', 'mapping', type=click.File('r'),
+              help='Create the links listed in a file, - for stdin, one boxId:innerPath<TAB>destination<TAB>soft|hard per line')
+@click.option('--pipeline', '-p', type=click.IntRange(1), default=64, help='Number of creations kept in flight per connection with --from, default to 64')
+@click.option('--workers', '-w', type=click.IntRange(1), default=1, help='Number of connections used with --from, default to 1')
 @report_exception
-def link(inner_src, dst, soft):
-    """Create link of src to destination location"""
-    id, inner_path = parse_inner_path(inner_src)
-    if dst[-1] == os.sep:
-        dst = os.path.join(dst, os.path.basename(inner_path))
+def link(inner_src, dst, soft, mapping, pipeline, workers):
+    """Create link of src to destination location
 
+    With --from, links are read and created as a stream: at most pipeline
+    creations per connection are in flight, so reading waits for the server.
+    Bad lines and failed creations are reported without stopping the rest.
+    """
     if soft:
         ltype = LinkType.SOFT
     else:
         ltype = LinkType.HARD
 
+    if mapping is not None:
+        if inner_src is not None:
+            raise Exception('INNER_SRC and DST cannot be used with --from')
+        link_from(mapping, ltype, pipeline, workers)
+        return
+    if inner_src is None or dst is None:
+        raise Exception('INNER_SRC and DST are required without --from')
+
     with LinkServiceSession() as client:
-        client.create(id, inner_path, dst, ltype)
+        client.create(*link_args(inner_src, dst, ltype))
+
+
+def link_args(inner_src, dst, ltype):
+    id, inner_path = parse_inner_path(inner_src)
+    if dst[-1] == os.sep:
+        dst = os.path.join(dst, os.path.basename(inner_path))
+    return id, inner_path, dst, ltype
+
+
+LINK_TYPES = {'soft': LinkType.SOFT, 's': LinkType.SOFT, 'hard': LinkType.HARD, 'h': LinkType.HARD}
+
+
+def read_mapping(mapping, ltype, bad_lines):
+    """read_mapping yields the create arguments of a mapping file, reporting bad lines into bad_lines"""
+    for lineno, line in enumerate(mapping, 1):
+        line = line.rstrip('\r\n')
+        if line.strip() == '' or line.startswith('#'):
+            continue
+        try:
+            fields = line.split('\t')
+            if len(fields) not in (2, 3):
+                raise Exception('expected 2 or 3 tab separated fields, got {}'.format(len(fields)))
+            line_type = ltype
+            if len(fields) == 3:
+                if fields[2].strip().lower() not in LINK_TYPES:
+                    raise Exception('unknown link type {}'.format(fields[2]))
+                line_type = LINK_TYPES[fields[2].strip().lower()]
+            yield link_args(fields[0], fields[1], line_type)
+        except Exception as e:
+            report_err('line {}: {}'.format(lineno, e))
+            bad_lines.append(lineno)
+
+
+def chunks(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def create_links(calls, window):
+    """create_links creates one chunk of links pipelined over the connection of the worker"""
+    with LinkServiceSession() as client:
+        return [(args, error) for args, _, error in pipelined(client, 'create', calls, window)]
+
+
+def link_from(mapping, ltype, pipeline, workers):
+    bad_lines = []
+    calls = read_mapping(mapping, ltype, bad_lines)
+    created, failed = 0, 0
+
+    def count(args, error):
+        nonlocal created, failed
+        if error is None:
+            created += 1
+            return
+        failed += 1
+        report_err('link {}:{} to {}: {}'.format(args[0], args[1], args[2], explain(error)))
+
+    if workers == 1:
+        with LinkServiceSession() as client:
+            for args, _, error in pipelined(client, 'create', calls, pipeline):
+                count(args, error)
+    else:
+        with WorkerPool(workers) as pool:
+            batches = ((chunk, pipeline) for chunk in chunks(calls, pipeline))
+            for (chunk, _), done, error in pool.map(create_links, batches):
+                # a broken connection fails the whole chunk
+                done = done if error is None else [(args, error) for args in chunk]
+                for args, e in done:
+                    count(args, e)
+
+    print('{} created, {} failed'.format(created, failed + len(bad_lines)))
+    if failed or bad_lines:
+        raise Exception('{} of {} links could not be created'.format(failed + len(bad_lines),
+                                                                     created + failed + len(bad_lines)))
 
 
 @click.command(name='ls-link', short_help='list links')
 @click.argument('target', type=str, default='all')
+@click.option('--dest-prefix', '-d', help='List links whose location starts with prefix, from the link index')
+@click.option('--inner-prefix', '-i', help='List links of a box or of boxId:innerPath and below, from the link index')
+@click.option('--refresh', is_flag=True, help='Rebuild the link index from the server before looking up')
+@output_option
 @report_exception
-def ls_link(target):
-    """List links"""
-    table_array = [['Type', 'Source', 'Location']]
-    for l in query_links(target):
-        if l.type == LinkType.SOFT:
-            t = 'S'
-        else:
-            t = 'H'
-        # print('{} {}:{} {}'.format(t, l.boxId, l.innerPath, l.destination))
-        table_array.append([t, '{}:{}'.format(l.boxId, l.innerPath), l.destination])
-    print(AsciiTable(table_array).table)
+def ls_link(target, dest_prefix, inner_prefix, refresh, output):
+    """List links
+
+    --dest-prefix and --inner-prefix answer from a link index kept in the
+    cache dir. Boxes whose links were listed more than link_index_ttl seconds
+    ago, or changed through this client, are listed again first.
+    """
+    if dest_prefix is not None or inner_prefix is not None:
+        if target != 'all' or (dest_prefix is not None and inner_prefix is not None):
+            raise Exception('use one of TARGET, --dest-prefix and --inner-prefix')
+        links = lookup_links(dest_prefix, inner_prefix, refresh)
+    else:
+        links = query_links(target)
+    with renderer(output, ['Type', 'Source', 'Location'], link_cells, Link) as r:
+        for l in links:
+            r.record(l)
+
+
+def link_cells(l):
+    if l.type == LinkType.SOFT:
+        t = 'S'
+    else:
+        t = 'H'
+    return [t, '{}:{}'.format(l.boxId, l.innerPath), l.destination]
 
 
 def query_links(target):
+    """query_links returns an iterator over the links of target, decoded as they arrive"""
+    if target == 'all':
+        return stream_links('lsAll')
+    splited = target.split(':')
+    if len(splited) == 1:
+        return stream_links('lsBox', int(splited[0]))
+    elif len(splited) == 2:
+        return stream_links('lsInner', int(splited[0]), splited[1])
+    else:
+        raise Exception('bad format')
+
+
+def lookup_links(dest_prefix, inner_prefix, refresh):
+    """lookup_links answers a prefix query from the link index, refreshing the boxes it holds stale"""
+    if inner_prefix is not None:
+        splited = inner_prefix.split(':', 1)
+        box_id = int(splited[0])
+        inner_path = splited[1] if len(splited) == 2 else '/'
+    if config.cache():
+        index = link_index()
+    else:
+        index = LinkIndex(path=':memory:')
+    refresh_index(index, refresh or not config.cache())
+    if inner_prefix is not None:
+        return index.by_inner(box_id, inner_path)
+    return index.by_destination(dest_prefix)
+
+
+def refresh_index(index, force=False, window=16):
+    """refresh_index lists again the links of the stale boxes of the index
+
+    Stale boxes are listed one by one through the pipeline, unless the index
+    is empty, forced, or stale for most boxes, when a single lsAll replaces
+    it. Boxes removed from the server are kept while links still point to
+    them, so dangling links can be found too.
+    """
+    with shared_session():
+        with BoxServiceSession() as client:
+            current = set(b.id for b in client.currentBoxes())
+        box_ids = current | set(index.indexed())
+        full = force or index.empty()
+        stale = [] if full else index.stale(box_ids)
+        with LinkServiceSession() as client:
+            if full or len(stale) * 2 > len(box_ids):
+                links = client.lsAll()
+                index.put(links, current | set(l.boxId for l in links), replace_all=True)
+                return
+            for (box_id,), box_links, error in pipelined(client, 'lsBox', [(i,) for i in stale], window):
+                if box_id in current:
+                    if error is not None:
+                        raise error
+                    index.put(box_links, [box_id])
+                elif error is None and box_links:
+                    index.put(box_links, [box_id])
+                else:
+                    index.drop([box_id])
+
+
+def stream_links(method, *args):
     with LinkServiceSession() as client:
-        if target == 'all':
-            return client.lsAll()
-        splited = target.split(':')
-        if len(splited) == 1:
-            return client.lsBox(int(splited[0]))
-        elif len(splited) == 2:
-            return client.lsInner(int(splited[0]), splited[1])
-        else:
-            raise Exception('bad format')
+        for l in stream_list(client, method, *args):
+            yield l
+
+
+@click.command(name='check-links', short_help='check link destinations')
+@click.argument('target', type=str, default='all')
+@click.option('--store-root', type=click.Path(exists=True, file_okay=False),
+              help='Directory holding box files as <store-root>/<boxId>/<innerPath>, to check where links point')
+@click.option('--workers', '-w', type=click.IntRange(1), default=32, help='Number of destinations checked at a time, default to 32')
+@output_option
+@report_exception
+def check_links(target, store_root, workers, output):
+    """Check that link destinations exist and point to their box files
+
+    Destinations are checked concurrently on the local filesystem while links
+    are streamed from the server. Dangling, hijacked and duplicate links are
+    listed, and the exit code is 1 when there is any.
+    """
+    counts = collections.Counter()
+    seen = {}
+    headers = ['Status', 'Type', 'Source', 'Location', 'Reason']
+    with renderer(output, headers, check_cells, Link, ('status', 'reason')) as r:
+        def calls():
+            for l in query_links(target):
+                counts['checked'] += 1
+                first = seen.get(l.destination)
+                if first is not None:
+                    counts['duplicate'] += 1
+                    r.record(l, 'duplicate', 'location also linked from {}:{}'.format(*first))
+                    continue
+                seen[l.destination] = (l.boxId, l.innerPath)
+                yield l, store_root
+
+        with WorkerPool(workers, sessions=False) as pool:
+            for (l, _), problem, error in pool.map(check_link, calls()):
+                if error is not None:
+                    problem = ('error', str(error))
+                if problem is not None:
+                    counts[problem[0]] += 1
+                    r.record(l, *problem)
+
+    click.echo('{} links checked, {} dangling, {} hijacked, {} duplicate, {} errors'.format(
+        counts['checked'], counts['dangling'], counts['hijacked'], counts['duplicate'], counts['error']), err=True)
+    problems = sum(counts[k] for k in ('dangling', 'hijacked', 'duplicate', 'error'))
+    if problems:
+        raise Exception('{} of {} links need attention'.format(problems, counts['checked']))
+
+
+def check_cells(l, status, reason):
+    return [status] + link_cells(l) + [reason]
+
+
+def check_link(l, store_root):
+    """check_link returns (status, reason) of a link whose destination is wrong, None when it is fine
+
+    A soft link must be a symbolic link to an existing target; with store_root
+    the target must be the box file, without it the target must end with the
+    inner path. A hard link must be a file with other hard links; with
+    store_root it must share the inode of the box file.
+    """
+    try:
+        st = os.lstat(l.destination)
+    except FileNotFoundError:
+        return 'dangling', 'location does not exist'
+    inner = normalize(l.innerPath)
+    source = None
+    if store_root is not None:
+        source = os.path.normpath(os.path.join(os.path.abspath(store_root), str(l.boxId), inner.lstrip('/')))
+    if l.type == LinkType.SOFT:
+        if not stat.S_ISLNK(st.st_mode):
+            return 'hijacked', 'location is not a symbolic link'
+        target = os.readlink(l.destination)
+        if source is not None:
+            resolved = os.path.normpath(os.path.join(os.path.dirname(os.path.abspath(l.destination)), target))
+            if resolved != source and os.path.realpath(l.destination) != os.path.realpath(source):
+                return 'hijacked', 'points to {}, not {}'.format(target, source)
+        elif inner != '/' and not os.path.normpath(target).endswith(inner):
+            # the root of a box can be anywhere without store_root
+            return 'hijacked', 'points to {}'.format(target)
+        if not os.path.exists(l.destination):
+            return 'dangling', 'target {} does not exist'.format(target)
+        return None
+    if stat.S_ISLNK(st.st_mode):
+        return 'hijacked', 'location is a symbolic link to {}'.format(os.readlink(l.destination))
+    if source is not None:
+        try:
+            src = os.stat(source)
+        except FileNotFoundError:
+            return 'dangling', 'box file {} does not exist'.format(source)
+        if (src.st_dev, src.st_ino) != (st.st_dev, st.st_ino):
+            return 'hijacked', 'location is not the same file as {}'.format(source)
+    elif not stat.S_ISDIR(st.st_mode) and st.st_nlink < 2:
+        return 'hijacked', 'location has no other hard link'
+    return None
+
+
+@click.command(name='reconcile-links', short_help='remove links of removed boxes and files')
+@click.option('--keep-archived', is_flag=True, help='Keep links of archived boxes')
+@click.option('--dry-run', '-n', is_flag=True, help='Only print the plan')
+@click.option('--pipeline', '-p', type=click.IntRange(1), default=16, help='Number of calls kept in flight, default to 16')
+@output_option
+@report_exception
+def reconcile_links(keep_archived, dry_run, pipeline, output):
+    """Remove links whose box or inner path no longer exists
+
+    Every link is compared with the boxes of the server and with live listings
+    of the directories holding the inner paths. The plan is printed, then
+    carried out after a single confirmation as pipelined removals by box and
+    by inner path, so a valid link sharing a location with a stale one stays.
+    All calls share one connection.
+    """
+    with shared_session():
+        # links first, a box created after the boxes are read would look removed
+        links = list(stream_links('lsAll'))
+        with BoxServiceSession() as client:
+            boxes = dict((b.id, b) for b in uncached(client).currentBoxes())
+        plan = stale_links(links, boxes, keep_archived, pipeline)
+
+        with renderer(output, ['Type', 'Source', 'Location', 'Reason'], plan_cells, Link, ('reason',)) as r:
+            for l, reason in plan:
+                r.record(l, reason)
+        click.echo('{} of {} links are stale'.format(len(plan), len(links)), err=True)
+        if not plan or dry_run:
+            return
+        if not ask_sure('remove {} stale links'.format(len(plan))):
+            print('Operation cancelled')
+            return
+
+        box_ids = sorted(set(l.boxId for l, reason in plan if reason != 'inner path missing'))
+        inner_paths = sorted(set((l.boxId, l.innerPath) for l, reason in plan if reason == 'inner path missing'))
+        with LinkServiceSession() as client:
+            failed = report_failures(pipelined(client, 'removeByBox', [(i,) for i in box_ids], pipeline),
+                                     lambda i: 'remove links of box {}'.format(i))
+            failed += report_failures(pipelined(client, 'removeByInner', inner_paths, pipeline),
+                                      lambda i, p: 'remove links of {}:{}'.format(i, p))
+        if failed:
+            raise Exception('{} of {} removals failed'.format(failed, len(box_ids) + len(inner_paths)))
+
+
+def plan_cells(l, reason):
+    return link_cells(l) + [reason]
+
+
+def stale_links(links, boxes, keep_archived, window):
+    """stale_links returns (link, reason) for the links of missing or archived boxes and of missing inner paths"""
+    plan = []
+    dirs = collections.OrderedDict()
+    for l in links:
+        box = boxes.get(l.boxId)
+        if box is None:
+            plan.append((l, 'box removed'))
+        elif box.status == BoxStatus.ARCHIVED and not keep_archived:
+            plan.append((l, 'box archived'))
+        elif normalize(l.innerPath) != '/':
+            dirs.setdefault((l.boxId, posixpath.dirname(normalize(l.innerPath))), []).append(l)
+
+    with FileServiceSession() as client:
+        for (box_id, inner_dir), items, error in pipelined(client, 'ls', list(dirs), window):
+            if isinstance(error, ServiceException):
+                names = set()
+            elif error is not None:
+                raise error
+            else:
+                names = set(i.name for i in items)
+            for l in dirs[(box_id, inner_dir)]:
+                if posixpath.basename(normalize(l.innerPath)) not in names:
+                    plan.append((l, 'inner path missing'))
+    return plan
 
 
 @click.command(name='rm-link', short_help='remove links')
 @click.option('--all', '-a', is_flag=True, help='Remove all links')
-@click.option('--id', '-i', default = 0, help='Specify link id')
-@click.option('--destination', '-d', default='', help='Specify link location')
+@click.option('--id', '-i', type=int, multiple=True, help='Specify link id, can be repeated')
+@click.option('--destination', '-d', multiple=True, help='Specify link location, can be repeated')
 @click.option('--box-path', '-b', default='', help='Specify box id')
+@click.option('--pipeline', '-p', type=click.IntRange(1), default=16, help='Number of removals kept in flight, default to 16')
 @report_exception
-def rm_link(all, id, destination, box_path):
+def rm_link(all, id, destination, box_path, pipeline):
     """Remove links"""
     with LinkServiceSession() as client:
         if all:
@@ -70,16 +405,18 @@ def rm_link(all, id, destination, box_path):
                 print('Operation cancelled')
                 return
             client.removeAll()
-        elif destination != '':
-            if not ask_sure('remove link at {}'.format(destination)):
+        elif destination:
+            if not ask_sure('remove link at {}'.format(', '.join(destination))):
                 print('Operation cancelled')
                 return
-            client.removeByDestination(destination)
-        elif id != 0:
-            if not ask_sure('remove link of id {}'.format(id)):
+            remove_links(client, 'removeByDestination', destination, pipeline,
+                         lambda d: 'remove link at {}'.format(d))
+        elif id:
+            if not ask_sure('remove link of id {}'.format(', '.join(str(i) for i in id))):
                 print('Operation cancelled')
                 return
-            client.removeById(id)
+            remove_links(client, 'removeById', id, pipeline,
+                         lambda i: 'remove link of id {}'.format(i))
         elif box_path != '':
             splited = box_path.split(':')
             if len(splited) == 1:
@@ -97,3 +434,9 @@ def rm_link(all, id, destination, box_path):
         else:
             print('No details have been specified, please read help')
             return
+
+
+def remove_links(client, method, keys, window, describe):
+    failed = report_failures(pipelined(client, method, [(k,) for k in keys], window), describe)
+    if failed:
+        raise Exception('{} of {} removals failed'.format(failed, len(keys)))
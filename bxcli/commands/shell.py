@@ -0,0 +1,131 @@
+import click
+import os.path
+import shlex
+
+try:
+    import readline
+except ImportError:
+    readline = None
+
+from ..config import history_file
+from ..tfclient import BoxServiceSession, FileServiceSession
+from ..tf.boxes.ttypes import LsType
+from ..util import Runner, report_err
+
+# commands whose first arguments are inner paths rather than bare box ids
+PATH_COMMANDS = {'add', 'fetch', 'rm', 'ls', 'find', 'move', 'copy', 'link', 'ls-link'}
+# commands after which cached box ids and listings may be stale
+MUTATING_COMMANDS = {'create', 'remove', 'archive', 'unarchive', 'set-name', 'set-description',
+                     'add', 'fetch', 'rm', 'move', 'copy'}
+UNAVAILABLE_COMMANDS = {'shell', 'agent'}
+
+
+class Completer(object):
+    """Completer completes command names, box ids and inner paths
+
+    Box ids are fetched once over the shell session and cached until a
+    mutating command is run; directory listings come from the listing cache.
+    """
+
+    def __init__(self, group):
+        self.group = group
+        self.box_ids = None
+        self.matches = []
+
+    def invalidate(self):
+        self.box_ids = None
+
+    def boxes(self):
+        if self.box_ids is None:
+            with BoxServiceSession() as client:
+                self.box_ids = sorted(b.id for b in client.currentBoxes())
+        return self.box_ids
+
+    def ls(self, id, path):
+        with FileServiceSession() as client:
+            return client.ls(id, path)
+
+    def candidates(self, words, text):
+        if not words:
+            return [name for name in self.group.list_commands(None) if name not in UNAVAILABLE_COMMANDS]
+        if words[0] not in PATH_COMMANDS:
+            return [str(id) for id in self.boxes()]
+        if ':' not in text:
+            return ['{}:'.format(id) for id in self.boxes()]
+
+        id, path = text.split(':', 1)
+        dir = os.path.dirname(path) or '/'
+        result = []
+        for item in self.ls(int(id), dir):
+            name = '{}:{}'.format(id, os.path.join(dir, item.name))
+            if item.type == LsType.DIR:
+                name += '/'
+            result.append(name)
+        return result
+
+    def complete(self, text, state):
+        if state == 0:
+            line = readline.get_line_buffer()[:readline.get_begidx()]
+            try:
+                words = shlex.split(line)
+                self.matches = [c for c in self.candidates(words, text) if c.startswith(text)]
+            except Exception:
+                self.matches = []
+        if state < len(self.matches):
+            return self.matches[state]
+        return None
+
+
+@click.command(name='shell', short_help='run commands in an interactive shell')
+def shell():
+    """Run commands interactively over one long-lived connection
+
+    Every command of boxes is available, one per line. Type exit or press
+    Ctrl-D to leave.
+    """
+    group = click.get_current_context().find_root().command
+    completer = Completer(group)
+    if readline is not None:
+        readline.set_completer_delims(' \t\n')
+        readline.set_completer(completer.complete)
+        readline.parse_and_bind('tab: complete')
+        try:
+            readline.read_history_file(history_file())
+        except OSError:
+            pass
+
+    runner = Runner(group)
+    try:
+        while True:
+            try:
+                line = input('boxes> ')
+            except EOFError:
+                print()
+                break
+            except KeyboardInterrupt:
+                print()
+                continue
+
+            try:
+                args = shlex.split(line)
+            except ValueError as e:
+                report_err(e)
+                continue
+            if not args:
+                continue
+            if args[0] in ('exit', 'quit'):
+                break
+            if args[0] in UNAVAILABLE_COMMANDS:
+                report_err('{} is not available inside shell'.format(args[0]))
+                continue
+
+            runner.run(args)
+            if args[0] in MUTATING_COMMANDS:
+                completer.invalidate()
+    finally:
+        runner.close()
+        if readline is not None:
+            try:
+                readline.write_history_file(history_file())
+            except OSError:
+                pass
@@ -1,11 +1,299 @@
+import collections
+import configparser
+import hashlib
 import os
+import tempfile
+from contextlib import contextmanager
+
+# settings given as options of the bxcli group, they take precedence over the environment
+_overrides = {}
+# settings read from the [bxcli] section of the config file, loaded on first use
+_file_settings = None
+
+PROTOCOLS = ('binary', 'compact')
+TRANSPORTS = ('buffered', 'framed')
+
+
+def override(name, value):
+    """override sets a setting for this invocation, None keeps the current value"""
+    if value is not None:
+        _overrides[name] = value
+
+
+@contextmanager
+def scoped_overrides():
+    """scoped_overrides restores the overrides on exit, so group options of one invocation do not leak"""
+    saved = dict(_overrides)
+    try:
+        yield
+    finally:
+        _overrides.clear()
+        _overrides.update(saved)
+
+
+def environment():
+    """environment returns the BXCLI_ variables of this process"""
+    return {name: value for name, value in os.environ.items() if name.startswith('BXCLI_')}
+
+
+@contextmanager
+def scoped_environment(env):
+    """scoped_environment replaces the BXCLI_ variables with env until exit, to run a command for another process"""
+    global _file_settings
+    saved = environment()
+    for name in saved:
+        del os.environ[name]
+    os.environ.update(env)
+    # BXCLI_CONFIG may point at another config file
+    _file_settings = None
+    try:
+        yield
+    finally:
+        for name in environment():
+            del os.environ[name]
+        os.environ.update(saved)
+        _file_settings = None
+
+
+def config_file():
+    """config_file returns path of the config file"""
+    path = os.environ.get('BXCLI_CONFIG')
+    if path:
+        return path
+    config_home = os.environ.get('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+    return os.path.join(config_home, 'bxcli', 'config.ini')
+
+
+def _from_file():
+    global _file_settings
+    if _file_settings is None:
+        parser = configparser.ConfigParser()
+        parser.read(config_file())
+        if parser.has_section('bxcli'):
+            _file_settings = dict(parser.items('bxcli'))
+        else:
+            _file_settings = {}
+    return _file_settings
+
+
+def _layers(name):
+    """_layers returns the values of a setting in group options, the environment and the config file, None where unset"""
+    env = os.environ.get('BXCLI_' + name.upper(), '')
+    return _overrides.get(name), env if env != '' else None, _from_file().get(name)
+
+
+def setting(name, default=None):
+    """setting looks a setting up in group options, then BXCLI_<NAME> in environment, then the config file"""
+    for value in _layers(name):
+        if value is not None:
+            return value
+    return default
+
+
+def _flag(name, default):
+    value = setting(name, default)
+    if isinstance(value, bool):
+        return value
+    return str(value).lower() not in ('', '0', 'no', 'off', 'false')
+
+
+def _choice(name, choices):
+    value = setting(name, choices[0]).lower()
+    if value not in choices:
+        raise ValueError('{} must be one of {}, got {}'.format(name, ', '.join(choices), value))
+    return value
+
+
+class Endpoint(collections.namedtuple('Endpoint', ['host', 'port', 'unix_socket'])):
+    """Endpoint is a server address, either host and port or the path of a unix socket"""
+
+    def __str__(self):
+        if self.unix_socket is not None:
+            return 'unix:' + self.unix_socket
+        if ':' in self.host:
+            return '[{}]:{}'.format(self.host, self.port)
+        return '{}:{}'.format(self.host, self.port)
+
+
+def parse_endpoint(s):
+    """parse_endpoint parses unix:/path, host:port or a bare host"""
+    s = s.strip()
+    if s.startswith('unix:'):
+        return Endpoint(None, None, s[len('unix:'):])
+    host, sep, server_port = s.rpartition(':')
+    if not sep:
+        return Endpoint(s, port(), None)
+    try:
+        return Endpoint(host.strip('[]'), int(server_port), None)
+    except ValueError:
+        raise ValueError('bad endpoint {}'.format(s))
+
+
+def host():
+    """host returns the server host name"""
+    return setting('host', 'localhost')
 
 
 def port():
-    """port reads port settings from environment"""
-    server_port = None
+    """port reads the server port from settings"""
+    try:
+        return int(setting('port', 6077))
+    except ValueError:
+        return 6077
+
+
+def unix_socket():
+    """unix_socket returns path of the server unix socket, None to connect over TCP"""
+    return setting('socket') or None
+
+
+def endpoints():
+    """endpoints returns the server addresses to try in order
+
+    The address comes from the first of group options, environment and config
+    file that sets one. Within it, an explicit endpoints list, comma
+    separated, wins over socket, which wins over host and port.
+    """
+    layers = zip(_layers('endpoints'), _layers('socket'), _layers('host'), _layers('port'))
+    for value, path, server_host, server_port in layers:
+        if value:
+            result = [parse_endpoint(e) for e in value.split(',') if e.strip() != '']
+            if not result:
+                raise ValueError('no server endpoint configured')
+            return result
+        if path:
+            return [Endpoint(None, None, path)]
+        if server_host is not None or server_port is not None:
+            break
+    return [Endpoint(host(), port(), None)]
+
+
+def timeout():
+    """timeout returns the socket timeout in seconds, None to wait forever"""
+    try:
+        value = float(setting('timeout', 0))
+    except ValueError:
+        return None
+    return value if value > 0 else None
+
+
+def protocol():
+    """protocol returns the wire protocol, binary or compact"""
+    return _choice('protocol', PROTOCOLS)
+
+
+def accelerate():
+    """accelerate tells whether protocols may encode and decode with their C extension"""
+    return _flag('accelerate', True)
+
+
+def transport():
+    """transport returns the transport framing, buffered or framed"""
+    return _choice('transport', TRANSPORTS)
+
+
+def zlib():
+    """zlib returns the zlib compression level of the transport, 0 when uncompressed"""
+    value = setting('zlib', 0)
+    if isinstance(value, bool) or str(value).lower() in ('yes', 'on', 'true'):
+        return 6 if value else 0
     try:
-        server_port = int(os.environ['BXCLI_PORT'])
-    except:
-        server_port = 6077
-    return server_port
+        level = int(value)
+    except ValueError:
+        return 0
+    return min(max(level, 0), 9)
+
+
+def agent_socket():
+    """agent_socket returns path of the unix socket the local agent listens on"""
+    path = os.environ.get('BXCLI_AGENT_SOCKET')
+    if path:
+        return path
+    runtime_dir = os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+    # one agent per set of servers
+    servers = hashlib.md5(','.join(str(e) for e in endpoints()).encode('utf-8')).hexdigest()[:8]
+    return os.path.join(runtime_dir, 'bxcli-agent-{}-{}.sock'.format(os.getuid(), servers))
+
+
+def agent_enabled():
+    """agent_enabled tells whether commands may be forwarded to a running agent"""
+    return os.environ.get('BXCLI_NO_AGENT', '') == ''
+
+
+def history_file():
+    """history_file returns path of the interactive shell history"""
+    return os.environ.get('BXCLI_HISTORY') or os.path.expanduser('~/.bxcli_history')
+
+
+def debug():
+    """debug tells whether diagnostic messages are printed to stderr"""
+    return _flag('debug', False)
+
+
+def cache_dir():
+    """cache_dir returns the directory of on-disk caches"""
+    path = setting('cache_dir')
+    if path:
+        return path
+    cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(cache_home, 'bxcli')
+
+
+def cache():
+    """cache tells whether cached server data may be used"""
+    return _flag('cache', True)
+
+
+def cache_ttl():
+    """cache_ttl returns for how many seconds cached box metadata stays valid"""
+    try:
+        return float(setting('cache_ttl', 60))
+    except ValueError:
+        return 60.0
+
+
+def ls_cache_size():
+    """ls_cache_size returns how many directory entries the listing cache holds at most"""
+    try:
+        return int(setting('ls_cache_size', 100000))
+    except ValueError:
+        return 100000
+
+
+def ls_cache_ttl():
+    """ls_cache_ttl returns for how many seconds a cached directory listing stays valid"""
+    try:
+        return float(setting('ls_cache_ttl', 30))
+    except ValueError:
+        return 30.0
+
+
+def table_sample():
+    """table_sample returns how many rows size the columns of a streamed table, 0 for header widths"""
+    try:
+        return max(int(setting('table_sample', 100)), 0)
+    except ValueError:
+        return 100
+
+
+def link_index_ttl():
+    """link_index_ttl returns for how many seconds the links of a box stay valid in the link index"""
+    try:
+        return float(setting('link_index_ttl', 300))
+    except ValueError:
+        return 300.0
+
+
+def trace():
+    """trace tells whether a summary of the calls of a command is printed to stderr"""
+    return _flag('trace', False)
+
+
+def trace_file():
+    """trace_file returns the path a Chrome trace of a command is written to, None for no file"""
+    return setting('trace_file') or None
+
+
+def tracing():
+    """tracing tells whether the calls of a command are traced, for a summary or a file"""
+    return trace() or trace_file() is not None
@@ -0,0 +1,12 @@
+import sys
+
+from . import agent
+
+
+def main():
+    """Entry point of the boxes script, forwards to the local agent before click or any command is loaded"""
+    code = agent.forward(sys.argv[1:])
+    if code is not None:
+        sys.exit(code)
+    from .bxcli import bxcli
+    bxcli(prog_name='boxes')
@@ -0,0 +1,133 @@
+import queue
+import threading
+
+from thrift.transport.TTransport import TTransportException
+
+from .tfclient import Session
+from .util import explain, report_err
+
+_STOP = object()
+
+
+class WorkerPool(object):
+    """WorkerPool runs calls on worker threads that each hold their own Session
+
+    Service sessions opened by a call borrow the connection of its worker, so a
+    pool of n workers keeps at most n connections open. A worker reconnects
+    after a call fails with a transport error. Results are collected in
+    completion order with next_result. Workers of a pool made with sessions
+    off never connect, for calls that do not reach the server.
+    """
+
+    def __init__(self, workers, sessions=True):
+        self.workers = max(workers, 1)
+        self.sessions = sessions
+        self.tasks = queue.Queue()
+        self.results = queue.Queue()
+        self.outstanding = 0
+        self.threads = []
+
+    def __enter__(self):
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self._work, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # calls not started yet are dropped, calls in flight are waited for
+        try:
+            while True:
+                self.tasks.get_nowait()
+        except queue.Empty:
+            pass
+        for _ in self.threads:
+            self.tasks.put(_STOP)
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+        return False
+
+    def _work(self):
+        session = None
+        try:
+            while True:
+                task = self.tasks.get()
+                if task is _STOP:
+                    return
+                func, args, tag = task
+                result, error = None, None
+                try:
+                    if session is None and self.sessions:
+                        session = Session().__enter__()
+                    result = func(*args)
+                except Exception as e:
+                    error = e
+                    if isinstance(e, TTransportException) and session is not None:
+                        session.__exit__(None, None, None)
+                        session = None
+                finally:
+                    # every task taken gets a result, or next_result would wait forever
+                    self.results.put((tag, result, error))
+        finally:
+            if session is not None:
+                session.__exit__(None, None, None)
+
+    def submit(self, func, *args, tag=None):
+        """submit queues func(*args), its result is returned by next_result along with tag"""
+        self.outstanding += 1
+        self.tasks.put((func, args, tag))
+
+    def next_result(self):
+        """next_result waits for a call to complete, returns its (tag, result, error)"""
+        done = self.results.get()
+        self.outstanding -= 1
+        return done
+
+    def map(self, func, calls, ordered=False):
+        """map calls func once per args tuple in calls, yields (args, result, error)
+
+        At most twice as many calls as workers are queued at a time. Results
+        come in completion order, or in the order of calls when ordered is set.
+        """
+        limit = 2 * self.workers
+        waiting = {}
+        next_index = 0
+
+        def collect():
+            nonlocal next_index
+            (index, args), result, error = self.next_result()
+            if not ordered:
+                yield args, result, error
+                return
+            waiting[index] = (args, result, error)
+            while next_index in waiting:
+                yield waiting.pop(next_index)
+                next_index += 1
+
+        for index, args in enumerate(calls):
+            self.submit(func, *args, tag=(index, args))
+            while self.outstanding >= limit:
+                for done in collect():
+                    yield done
+        while self.outstanding:
+            for done in collect():
+                yield done
+
+
+def run_parallel(func, calls, workers, describe, ordered=False):
+    """run_parallel calls func once per args tuple in calls on a WorkerPool
+
+    Every call is reported as it completes, or in the order of calls when
+    ordered is set, and failures do not stop the others. It returns how many
+    calls failed.
+    """
+    failed = 0
+    with WorkerPool(workers) as pool:
+        for args, _, error in pool.map(func, calls, ordered):
+            if error is not None:
+                failed += 1
+                report_err('{}: {}'.format(describe(*args), explain(error)))
+            else:
+                print('{}: ok'.format(describe(*args)))
+    return failed
@@ -0,0 +1,226 @@
+import csv
+import json
+import sys
+import unicodedata
+
+import click
+
+from . import config
+
+FORMATS = ('table', 'plain', 'json', 'ndjson', 'csv', 'tsv')
+
+# field names of struct classes, read once from their thrift_spec
+_fields = {}
+
+
+def fields(struct_class):
+    """fields returns the field names of a generated struct class in id order"""
+    names = _fields.get(struct_class)
+    if names is None:
+        names = tuple(spec[2] for spec in struct_class.thrift_spec if spec is not None)
+        _fields[struct_class] = names
+    return names
+
+
+def to_dict(struct):
+    """to_dict converts a generated struct, and the structs inside it, to a dict"""
+    return dict((name, _plain(getattr(struct, name))) for name in fields(type(struct)))
+
+
+def _plain(value):
+    if hasattr(value, 'thrift_spec'):
+        return to_dict(value)
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return [_plain(v) for v in value]
+    if isinstance(value, dict):
+        return dict((_plain(k), _plain(v)) for k, v in value.items())
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'replace')
+    return value
+
+
+def _text(value):
+    if value is None:
+        return ''
+    return str(value)
+
+
+def _width(text):
+    """_width is the number of terminal columns text takes, wide east asian characters take two"""
+    if text.isascii():
+        return len(text)
+    return sum(2 if unicodedata.east_asian_width(c) in ('F', 'W') else 1 for c in text)
+
+
+def _pad(text, width):
+    return text + ' ' * (width - _width(text))
+
+
+class Renderer(object):
+    """Renderer prints the records of a listing as they are produced
+
+    A record is a generated struct plus optional extra values named by
+    extra_fields. Human readable formats show the cells computed by
+    cells(struct, *extra) under headers; machine readable formats show the
+    extra values and the struct fields named after the thrift_spec. Use it as
+    a context manager: whatever is still buffered is printed on a clean exit.
+    """
+
+    def __init__(self, headers, cells, struct_class, extra_fields=(), out=None):
+        self.headers = headers
+        self.cells = cells
+        self.names = tuple(extra_fields) + fields(struct_class)
+        self.out = out or sys.stdout
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is None:
+            self.close()
+        return False
+
+    def record(self, struct, *extra):
+        pass
+
+    def values(self, struct, extra):
+        return list(extra) + [_plain(getattr(struct, name)) for name in fields(type(struct))]
+
+    def close(self):
+        pass
+
+
+class TableRenderer(Renderer):
+    """TableRenderer draws an ascii table with column widths taken from the first rows
+
+    Up to sample rows are buffered to size the columns; later rows are printed
+    right away, and cells wider than their column stretch their line. With a
+    sample of 0 the columns are as wide as their headers.
+    """
+
+    def __init__(self, headers, cells, struct_class, extra_fields=(), out=None, sample=None):
+        super(TableRenderer, self).__init__(headers, cells, struct_class, extra_fields, out)
+        self.sample = config.table_sample() if sample is None else sample
+        self.buffered = []
+        self.widths = None
+
+    def _line(self, cells):
+        return '| ' + ' | '.join(_pad(c, w) for c, w in zip(cells, self.widths)) + ' |'
+
+    def _border(self):
+        return '+' + '+'.join('-' * (w + 2) for w in self.widths) + '+'
+
+    def _start(self):
+        self.widths = [_width(h) for h in self.headers]
+        for cells in self.buffered:
+            self.widths = [max(w, _width(c)) for w, c in zip(self.widths, cells)]
+        print(self._border(), file=self.out)
+        print(self._line(self.headers), file=self.out)
+        print(self._border(), file=self.out)
+        for cells in self.buffered:
+            print(self._line(cells), file=self.out)
+        self.buffered = []
+
+    def record(self, struct, *extra):
+        cells = [_text(v) for v in self.cells(struct, *extra)]
+        if self.widths is not None:
+            print(self._line(cells), file=self.out)
+            return
+        self.buffered.append(cells)
+        if len(self.buffered) >= self.sample:
+            self._start()
+
+    def close(self):
+        if self.widths is None:
+            self._start()
+        print(self._border(), file=self.out)
+
+
+class PlainRenderer(TableRenderer):
+    """PlainRenderer prints columns separated by spaces, without borders or headers"""
+
+    def _line(self, cells):
+        return '  '.join(_pad(c, w) for c, w in zip(cells, self.widths)).rstrip()
+
+    def _start(self):
+        self.widths = [0] * len(self.headers)
+        for cells in self.buffered:
+            self.widths = [max(w, _width(c)) for w, c in zip(self.widths, cells)]
+        for cells in self.buffered:
+            print(self._line(cells), file=self.out)
+        self.buffered = []
+
+    def close(self):
+        if self.widths is None:
+            self._start()
+
+
+class JsonRenderer(Renderer):
+    """JsonRenderer prints a JSON array of objects, one element at a time"""
+
+    def __init__(self, *args, **kwargs):
+        super(JsonRenderer, self).__init__(*args, **kwargs)
+        self.count = 0
+
+    def record(self, struct, *extra):
+        obj = json.dumps(dict(zip(self.names, self.values(struct, extra))))
+        if self.count == 0:
+            self.out.write('[\n' + obj)
+        else:
+            self.out.write(',\n' + obj)
+        self.count += 1
+
+    def close(self):
+        if self.count == 0:
+            print('[]', file=self.out)
+        else:
+            self.out.write('\n]\n')
+
+
+class NdjsonRenderer(Renderer):
+    """NdjsonRenderer prints one JSON object per line"""
+
+    def record(self, struct, *extra):
+        print(json.dumps(dict(zip(self.names, self.values(struct, extra)))), file=self.out)
+
+
+class CsvRenderer(Renderer):
+    """CsvRenderer prints a header line of field names and one comma separated line per record"""
+
+    dialect = 'excel'
+
+    def __enter__(self):
+        self.writer = csv.writer(self.out, dialect=self.dialect, lineterminator='\n')
+        self.writer.writerow(self.names)
+        return self
+
+    def record(self, struct, *extra):
+        self.writer.writerow([_text(v) for v in self.values(struct, extra)])
+
+
+class TsvRenderer(CsvRenderer):
+    """TsvRenderer prints a header line of field names and one tab separated line per record"""
+
+    dialect = 'excel-tab'
+
+
+_RENDERERS = {
+    'table': TableRenderer,
+    'plain': PlainRenderer,
+    'json': JsonRenderer,
+    'ndjson': NdjsonRenderer,
+    'csv': CsvRenderer,
+    'tsv': TsvRenderer,
+}
+
+
+def renderer(fmt, headers, cells, struct_class, extra_fields=()):
+    """renderer returns the Renderer of an output format"""
+    return _RENDERERS[fmt](headers, cells, struct_class, extra_fields)
+
+
+def output_option(func):
+    """output_option adds the --output option choosing a listing format"""
+    return click.option('--output', '-o', type=click.Choice(FORMATS), default='table',
+                        help='Output format, table and plain for humans, json, ndjson, csv and tsv '
+                             'with the fields of the records, default to table')(func)
@@ -1,11 +1,242 @@
+import collections
+import importlib
+import logging
+import sys
+import threading
 from abc import ABCMeta, abstractmethod
+from contextlib import contextmanager
 
+from thrift.Thrift import TApplicationException, TMessageType, TType
 from thrift.transport import TSocket
 from thrift.transport import TTransport
-from thrift.protocol import TMultiplexedProtocol, TBinaryProtocol
+from thrift.transport import TZlibTransport
+from thrift.protocol import TMultiplexedProtocol, TBinaryProtocol, TCompactProtocol, TProtocolDecorator
 
 from . import config
-from .tf.boxes import BoxService, FileService, LinkService
+from .cache import BoxCache, CachingClient, CachingBoxClient, CachingFileClient, CachingLinkClient, link_index, ls_cache
+from .tf.boxes.ttypes import ServiceException
+from .util import debug
+
+
+_local = threading.local()
+
+
+def service(name):
+    """service imports the generated module of a service on first use, commands needing one service skip the others"""
+    return importlib.import_module('.tf.boxes.' + name, __package__)
+
+
+# failed connection attempts are reported by open_connection, with failover in mind
+logging.getLogger(TSocket.__name__).setLevel(logging.CRITICAL)
+
+
+def open_connection():
+    """open_connection dials the server and returns the opened transport and its protocol"""
+    error = None
+    tracing = config.tracing()
+    if tracing:
+        from . import trace
+    for endpoint in config.endpoints():
+        sock = dial(endpoint)
+        if tracing:
+            sock = trace.TracingTransport(sock, endpoint)
+        transport = wrap_transport(sock)
+        protocol = make_protocol(transport)
+        if tracing:
+            protocol = trace.TracingProtocol(protocol, sock)
+        try:
+            transport.open()
+        except TTransport.TTransportException as e:
+            debug('cannot connect to {}: {}'.format(endpoint, e))
+            error = e
+            continue
+        debug('connected to {}, codec: {}, transport: {}'.format(endpoint, codec(protocol), describe_transport()))
+        return transport, protocol
+    raise error
+
+
+def connection_settings():
+    """connection_settings returns the settings a connection is opened with, a connection opened with others is reopened"""
+    return tuple(config.endpoints()), config.protocol(), config.accelerate(), config.transport(), config.zlib(), config.timeout()
+
+
+def dial(endpoint):
+    """dial creates the unopened socket of an endpoint"""
+    if endpoint.unix_socket is not None:
+        sock = TSocket.TSocket(unix_socket=endpoint.unix_socket)
+    else:
+        sock = TSocket.TSocket(endpoint.host, endpoint.port)
+    if config.timeout() is not None:
+        sock.setTimeout(config.timeout() * 1000)
+    return sock
+
+
+def wrap_transport(transport):
+    """wrap_transport stacks the configured compression and framing on a raw transport"""
+    level = config.zlib()
+    if level:
+        transport = TZlibTransport.TZlibTransport(transport, level)
+    if config.transport() == 'framed':
+        return TTransport.TFramedTransport(transport)
+    return TTransport.TBufferedTransport(transport)
+
+
+def make_protocol(transport):
+    """make_protocol builds the configured protocol over a transport"""
+    name, accelerate = config.protocol(), config.accelerate()
+    if name == 'compact':
+        if accelerate:
+            return TCompactProtocol.TCompactProtocolAccelerated(transport, fallback=True)
+        return TCompactProtocol.TCompactProtocol(transport)
+    if accelerate:
+        # decodes structs with the fastbinary C extension, or in pure Python when it is not built
+        return TBinaryProtocol.TBinaryProtocolAccelerated(transport, fallback=True)
+    return TBinaryProtocol.TBinaryProtocol(transport)
+
+
+def codec(protocol):
+    """codec names the codec a protocol encodes and decodes structs with"""
+    name = config.protocol()
+    if protocol._fast_decode is not None:
+        return 'accelerated {} (fastbinary extension)'.format(name)
+    if config.accelerate():
+        return '{} (pure Python, fastbinary extension not available)'.format(name)
+    return '{} (pure Python)'.format(name)
+
+
+def describe_transport():
+    level = config.zlib()
+    if level:
+        return '{} over zlib level {}'.format(config.transport(), level)
+    return config.transport()
+
+
+def current_session():
+    """current_session returns the innermost active Session of the calling thread, or None"""
+    return getattr(_local, 'session', None)
+
+
+def matching_session():
+    """matching_session returns the current Session when its connection was opened with the current settings, or None
+
+    Group options given on a line of shell or batch may select another server
+    than the one the shared session is connected to.
+    """
+    session = current_session()
+    if session is not None and session.settings == connection_settings():
+        return session
+    return None
+
+
+@contextmanager
+def shared_session():
+    """shared_session makes the service sessions opened inside it share one connection, the active Session's if it matches"""
+    session = matching_session()
+    if session is not None:
+        yield session
+        return
+    with Session() as session:
+        yield session
+
+
+class Session(object):
+    """Session shares one connection among BoxService, FileService and LinkService clients
+
+    While a session is active, every XxxServiceSession opened in the same thread
+    reuses its connection instead of dialing a new one.
+    """
+
+    def __init__(self):
+        self.transport = None
+        self.protocol = None
+        self.traced = False
+        self.settings = None
+        self._outer = None
+        self._clients = {}
+
+    def multiplexed(self, service_name):
+        return TMultiplexedProtocol.TMultiplexedProtocol(self.protocol, service_name)
+
+    def _client(self, service_name, wrap):
+        # clients, and the generated modules behind them, are made on first use, with caching as currently set
+        key = (service_name, config.cache())
+        if key not in self._clients:
+            self._clients[key] = wrap(service(service_name).Client(self.multiplexed(service_name)))
+        return self._clients[key]
+
+    @property
+    def box(self):
+        return self._client('BoxService', box_client)
+
+    @property
+    def file(self):
+        return self._client('FileService', file_client)
+
+    @property
+    def link(self):
+        return self._client('LinkService', link_client)
+
+    def __enter__(self):
+        self.settings = connection_settings()
+        self.transport, self.protocol = open_connection()
+        self.traced = config.tracing()
+        self._outer = current_session()
+        _local.session = self
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        _local.session = self._outer
+        self._outer = None
+        self._close()
+        return False
+
+    def _close(self):
+        for client in self._clients.values():
+            close_client(client)
+        self._clients = {}
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+
+    def reopen(self):
+        """reopen replaces the connection with a new one opened with the current settings, e.g. to trace it"""
+        self._close()
+        self.settings = connection_settings()
+        self.transport, self.protocol = open_connection()
+        self.traced = config.tracing()
+
+
+def box_client(client):
+    """box_client serves box metadata from the on-disk cache unless caching is disabled"""
+    if config.cache():
+        return CachingBoxClient(client, BoxCache())
+    return client
+
+
+def file_client(client):
+    """file_client serves directory listings from the in-memory cache unless caching is disabled"""
+    if config.cache():
+        return CachingFileClient(client, ls_cache())
+    return client
+
+
+def link_client(client):
+    """link_client keeps the link index current with the links changed through client unless caching is disabled"""
+    if config.cache():
+        return CachingLinkClient(client, link_index())
+    return client
+
+
+def uncached(client):
+    """uncached returns the service client wrapped by a caching client, to read the server directly"""
+    if isinstance(client, CachingClient):
+        return client.client
+    return client
+
+
+def close_client(client):
+    if isinstance(client, CachingClient):
+        client.close()
 
 
 class ClientSession(metaclass=ABCMeta):
@@ -16,17 +247,22 @@ class ClientSession(metaclass=ABCMeta):
 
     @abstractmethod
     def __enter__(self):
-        transport = TSocket.TSocket('localhost', config.port())
-        transport = TTransport.TBufferedTransport(transport)
-        protocol = TBinaryProtocol.TBinaryProtocol(transport)
-        protocol = TMultiplexedProtocol.TMultiplexedProtocol(protocol, self.service_name())
+        shared = matching_session()
+        if shared is not None:
+            self.transport = None
+            self.protocol = shared.multiplexed(self.service_name())
+            return
 
-        transport.open()
+        transport, protocol = open_connection()
+        protocol = TMultiplexedProtocol.TMultiplexedProtocol(protocol, self.service_name())
         self.transport = transport
         self.protocol = protocol
 
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.transport.close()
+        close_client(getattr(self, 'client', None))
+        # connections borrowed from a shared Session are closed by the session itself
+        if self.transport is not None:
+            self.transport.close()
         return False
 
 
@@ -37,7 +273,8 @@ class BoxServiceSession(ClientSession):
 
     def __enter__(self):
         super(BoxServiceSession, self).__enter__()
-        return BoxService.Client(self.protocol)
+        self.client = box_client(service('BoxService').Client(self.protocol))
+        return self.client
 
 
 class FileServiceSession(ClientSession):
@@ -47,7 +284,8 @@ class FileServiceSession(ClientSession):
 
     def __enter__(self):
         super(FileServiceSession, self).__enter__()
-        return FileService.Client(self.protocol)
+        self.client = file_client(service('FileService').Client(self.protocol))
+        return self.client
 
 
 class LinkServiceSession(ClientSession):
@@ -57,4 +295,132 @@ class LinkServiceSession(ClientSession):
 
     def __enter__(self):
         super(LinkServiceSession, self).__enter__()
-        return LinkService.Client(self.protocol)
+        self.client = link_client(service('LinkService').Client(self.protocol))
+        return self.client
+
+
+class _SeqidRecorder(TProtocolDecorator.TProtocolDecorator):
+    """_SeqidRecorder remembers the seqid of the last message read"""
+
+    def __init__(self, protocol):
+        self.seqid = None
+
+    def readMessageBegin(self):
+        (fname, mtype, rseqid) = super(_SeqidRecorder, self).readMessageBegin()
+        self.seqid = rseqid
+        return fname, mtype, rseqid
+
+
+class Pipeline(object):
+    """Pipeline keeps up to window requests of a service client in flight on its connection
+
+    Requests are written with the generated send_ methods and the responses are
+    drained in order with the matching recv_ methods, so a batch of calls costs
+    one round trip per window instead of one per call. Every request carries its
+    own seqid, which is checked against the response.
+    """
+
+    def __init__(self, client, window):
+        # caching wrappers are bypassed on the wire but told about every successful call
+        self.wrapper = client if isinstance(client, CachingClient) else None
+        if self.wrapper is not None:
+            client = client.client
+        self.recorder = _SeqidRecorder(client._iprot)
+        self.client = type(client)(self.recorder, client._oprot)
+        self.window = max(window, 1)
+        self.pending = collections.deque()
+        self.seqid = 0
+
+    def submit(self, method, args, tag=None):
+        """submit sends one call, returns the (tag, result, error) of the calls completed to make room for it"""
+        done = []
+        while len(self.pending) >= self.window:
+            done.append(self.complete())
+        self.seqid += 1
+        self.client._seqid = self.seqid
+        getattr(self.client, 'send_' + method)(*args)
+        self.pending.append((self.seqid, method, args, tag))
+        return done
+
+    def complete(self):
+        seqid, method, args, tag = self.pending.popleft()
+        result, error = None, None
+        try:
+            result = getattr(self.client, 'recv_' + method)()
+        except (ServiceException, TApplicationException) as e:
+            # the failed response is read completely, the connection is still usable
+            error = e
+        if self.recorder.seqid != seqid:
+            raise TApplicationException(TApplicationException.BAD_SEQUENCE_ID,
+                                        '{} expected seqid {}, got {}'.format(method, seqid, self.recorder.seqid))
+        if error is None and self.wrapper is not None:
+            self.wrapper.completed(method, args)
+        return tag, result, error
+
+    def drain(self):
+        """drain waits for every call in flight, returns their (tag, result, error)"""
+        done = []
+        while self.pending:
+            done.append(self.complete())
+        return done
+
+
+def pipelined(client, method, calls, window):
+    """pipelined calls method once per args tuple in calls, yields (args, result, error) in order"""
+    pipeline = Pipeline(client, window)
+    for args in calls:
+        for done in pipeline.submit(method, args, args):
+            yield done
+    for done in pipeline.drain():
+        yield done
+
+
+def stream_list(client, method, *args):
+    """stream_list calls a method returning a list, yields the elements as they are decoded
+
+    Unlike the generated recv_ methods, the response is never held in memory as
+    a whole. Elements left when the iteration stops early are read and dropped,
+    so the connection stays usable.
+    """
+    client = uncached(client)
+    getattr(client, 'send_' + method)(*args)
+
+    iprot = client._iprot
+    (fname, mtype, rseqid) = iprot.readMessageBegin()
+    if mtype == TMessageType.EXCEPTION:
+        x = TApplicationException()
+        x.read(iprot)
+        iprot.readMessageEnd()
+        raise x
+    result_spec = getattr(sys.modules[type(client).__module__], method + '_result').thrift_spec
+    element_class = result_spec[0][3][1][0]
+
+    error = None
+    abandoned = False
+    iprot.readStructBegin()
+    while True:
+        (fname, ftype, fid) = iprot.readFieldBegin()
+        if ftype == TType.STOP:
+            break
+        if fid == 0 and ftype == TType.LIST:
+            (etype, size) = iprot.readListBegin()
+            for _ in range(size):
+                element = element_class()
+                element.read(iprot)
+                if abandoned:
+                    continue
+                try:
+                    yield element
+                except GeneratorExit:
+                    abandoned = True
+            iprot.readListEnd()
+        elif fid == 1 and ftype == TType.STRUCT:
+            error = ServiceException()
+            error.read(iprot)
+        else:
+            iprot.skip(ftype)
+        iprot.readFieldEnd()
+    iprot.readStructEnd()
+    iprot.readMessageEnd()
+    if error is not None and not abandoned:
+        raise error
@@ -0,0 +1,211 @@
+import collections
+import json
+import os
+import sys
+import threading
+import time
+
+from thrift.protocol import TProtocolDecorator
+from thrift.transport import TTransport
+
+# the Tracer of the running command, None when tracing is off
+_tracer = None
+
+
+class Tracer(object):
+    """Tracer collects the connections and calls of one command
+
+    Times are taken with perf_counter and kept relative to the start of the
+    command. finish prints a summary per method and can write a Chrome trace
+    file.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.start = time.perf_counter()
+        self.lock = threading.Lock()
+        self.connects = []
+        self.calls = []
+
+    def connected(self, endpoint, start, end, error=None):
+        with self.lock:
+            self.connects.append((str(endpoint), threading.get_ident(), start, end, error))
+
+    def called(self, call):
+        with self.lock:
+            self.calls.append(call)
+
+    def summary(self, end, out):
+        methods = collections.OrderedDict()
+        for c in self.calls:
+            m = methods.setdefault(c.name, [0, 0.0, 0.0, 0.0, 0.0, 0.0, 0, 0])
+            for i, value in enumerate((1, c.done - c.begin, c.encoded - c.begin, c.send, c.reply - c.wait_from,
+                                       c.done - c.reply, c.bytes_out, c.bytes_in)):
+                m[i] += value
+        connect = sum(e - s for _, _, s, e, _ in self.connects)
+        rpc = sum(c.done - c.begin for c in self.calls)
+        print('trace: {} took {:.1f}ms, {} connections in {:.1f}ms, {} calls in {:.1f}ms'.format(
+            self.command, (end - self.start) * 1000, len(self.connects), connect * 1000, len(self.calls), rpc * 1000),
+            file=out)
+        if not methods:
+            return
+        print('{:<32} {:>6} {:>9} {:>9} {:>9} {:>9} {:>9} {:>10} {:>10}'.format(
+            'method', 'calls', 'total ms', 'encode', 'send', 'wait', 'decode', 'bytes out', 'bytes in'), file=out)
+        for name, m in methods.items():
+            print('{:<32} {:>6} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>9.2f} {:>10} {:>10}'.format(
+                name, m[0], m[1] * 1000, m[2] * 1000, m[3] * 1000, m[4] * 1000, m[5] * 1000, m[6], m[7]), file=out)
+
+    def chrome(self, end, path):
+        """chrome writes the events in the Chrome trace event format, for chrome://tracing or Perfetto"""
+        pid = os.getpid()
+
+        def event(name, cat, tid, start, end, **args):
+            return {'name': name, 'cat': cat, 'ph': 'X', 'pid': pid, 'tid': tid,
+                    'ts': round((start - self.start) * 1e6, 1), 'dur': round((end - start) * 1e6, 1), 'args': args}
+
+        events = [event(self.command, 'command', threading.get_ident(), self.start, end)]
+        for endpoint, tid, start, finish, error in self.connects:
+            events.append(event('connect', 'connect', tid, start, finish, endpoint=endpoint, error=error))
+        for c in self.calls:
+            events.append(event(c.name, 'rpc', c.tid, c.begin, c.done, seqid=c.seqid, bytes_out=c.bytes_out,
+                                bytes_in=c.bytes_in, send_ms=round(c.send * 1000, 3)))
+            events.append(event('encode', 'rpc.encode', c.tid, c.begin, c.encoded))
+            events.append(event('wait', 'rpc.wait', c.tid, c.wait_from, c.reply))
+            events.append(event('decode', 'rpc.decode', c.tid, c.reply, c.done))
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+
+class _Call(object):
+    """_Call is the timing of one request and its response"""
+
+    def __init__(self, name, seqid):
+        self.name = name
+        self.seqid = seqid
+        self.tid = threading.get_ident()
+        self.begin = time.perf_counter()
+        self.encoded = self.wait_from = self.reply = self.done = self.begin
+        self.send = 0.0
+        self.bytes_out = 0
+        self.bytes_in = 0
+
+
+class TracingTransport(TTransport.TTransportBase):
+    """TracingTransport times the connection of a raw transport and counts the bytes it moves
+
+    It sits under compression and framing, so the bytes are those on the
+    wire. Bytes and write time go to the call being sent or read, as marked
+    by TracingProtocol; with pipelined calls the split is approximate. Calls
+    are recorded by the Tracer running when they complete, so a connection
+    kept across commands, as by shell or the agent, traces each of them.
+    """
+
+    def __init__(self, transport, endpoint):
+        self.transport = transport
+        self.endpoint = endpoint
+        # calls sent and not answered yet, answered in order on one connection
+        self.pending = collections.deque()
+        self.sending = None
+        self.receiving = None
+
+    def isOpen(self):
+        return self.transport.isOpen()
+
+    def open(self):
+        start = time.perf_counter()
+        error = None
+        try:
+            self.transport.open()
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            tracer = current()
+            if tracer is not None:
+                tracer.connected(self.endpoint, start, time.perf_counter(), error)
+
+    def close(self):
+        self.transport.close()
+
+    def read(self, sz):
+        buff = self.transport.read(sz)
+        if self.receiving is not None:
+            self.receiving.bytes_in += len(buff)
+        return buff
+
+    def write(self, buf):
+        start = time.perf_counter()
+        self.transport.write(buf)
+        if self.sending is not None:
+            self.sending.send += time.perf_counter() - start
+            self.sending.bytes_out += len(buf)
+
+    def flush(self):
+        self.transport.flush()
+
+
+class TracingProtocol(TProtocolDecorator.TProtocolDecorator):
+    """TracingProtocol marks where the messages of a call begin and end for its TracingTransport
+
+    encode runs from the start of the request to its end, wait from asking
+    for the response to its first field, and decode from there to the end
+    of the response. Listings streamed by stream_list decode while they are
+    rendered.
+    """
+
+    def __init__(self, protocol, traced):
+        self.traced = traced
+
+    def writeMessageBegin(self, name, type, seqid):
+        call = _Call(name, seqid)
+        self.traced.pending.append(call)
+        self.traced.sending = call
+        super(TracingProtocol, self).writeMessageBegin(name, type, seqid)
+
+    def writeMessageEnd(self):
+        super(TracingProtocol, self).writeMessageEnd()
+        if self.traced.sending is not None:
+            self.traced.sending.encoded = time.perf_counter()
+
+    def readMessageBegin(self):
+        call = self.traced.pending.popleft() if self.traced.pending else None
+        if call is not None:
+            call.wait_from = time.perf_counter()
+        self.traced.receiving = call
+        result = super(TracingProtocol, self).readMessageBegin()
+        if call is not None:
+            call.reply = time.perf_counter()
+        return result
+
+    def readMessageEnd(self):
+        super(TracingProtocol, self).readMessageEnd()
+        call, self.traced.receiving = self.traced.receiving, None
+        tracer = current()
+        if call is not None and tracer is not None:
+            call.done = time.perf_counter()
+            tracer.called(call)
+
+
+def start(command):
+    """start traces the calls of a command until finish"""
+    global _tracer
+    _tracer = Tracer(command)
+    return _tracer
+
+
+def current():
+    """current returns the Tracer of the running command, None when tracing is off"""
+    return _tracer
+
+
+def finish(summary=True, path=None):
+    """finish stops tracing, prints the summary to stderr and writes a Chrome trace to path when given"""
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is None:
+        return
+    end = time.perf_counter()
+    if summary:
+        tracer.summary(end, sys.stderr)
+    if path:
+        tracer.chrome(end, path)
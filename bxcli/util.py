@@ -1,19 +1,71 @@
 import sys
+from contextlib import contextmanager
 
+import click
+
+from . import config
 from .tf.boxes.ttypes import ServiceException
 
+# answer given by ask_sure without prompting, None to prompt
+_assumed_answer = None
+# how many operations ask_sure did not get confirmed for
+_declined = 0
+
+
 def ask_sure(hint):
-    ans = input('Are you sure to continue to {}, y or N ? '.format(hint))
-    ans = ans.upper()
-    if ans == 'Y':
-        return True
-    return False
+    global _declined
+    if _assumed_answer is not None:
+        sure = _assumed_answer
+    else:
+        ans = input('Are you sure to continue to {}, y or N ? '.format(hint))
+        sure = ans.upper() == 'Y'
+    if not sure:
+        _declined += 1
+    return sure
+
+
+def declined():
+    """declined returns how many confirmations ask_sure declined so far, to tell a cancelled command from a done one"""
+    return _declined
+
+
+@contextmanager
+def assume_answer(answer):
+    """assume_answer makes ask_sure return answer without prompting, None restores prompting"""
+    global _assumed_answer
+    outer, _assumed_answer = _assumed_answer, answer
+    try:
+        yield
+    finally:
+        _assumed_answer = outer
 
 
 def report_err(e):
     print('Error: {}'.format(e), file=sys.stderr)
 
 
+def debug(msg):
+    if config.debug():
+        print('Debug: {}'.format(msg), file=sys.stderr)
+
+
+def explain(e):
+    """explain describes an error raised by a service call"""
+    if isinstance(e, ServiceException):
+        return '{}: {}'.format(e.op, e.why)
+    return str(e)
+
+
+def report_failures(results, describe):
+    """report_failures reports the failed calls among (args, result, error) results, returns how many failed"""
+    failed = 0
+    for args, _, error in results:
+        if error is not None:
+            failed += 1
+            report_err('{}: {}'.format(describe(*args), explain(error)))
+    return failed
+
+
 class InnerPathFormatException(Exception):
 
     def __init__(self):
@@ -32,8 +84,74 @@ def report_exception(func):
     def wrapper(*args, **kwargs):
         try:
             func(*args, **kwargs)
-        except ServiceException as se:
-            report_err('{}: {}'.format(se.op, se.why))
         except Exception as e:
-            report_err(e)
+            report_err(explain(e))
+            sys.exit(1)
     return wrapper
+
+
+def invoke(group, args):
+    """invoke runs one command line against the click group in-process and returns its exit code"""
+    try:
+        with config.scoped_overrides():
+            rv = group.main(args=args, prog_name='boxes', standalone_mode=False)
+    except click.ClickException as e:
+        e.show()
+        return e.exit_code
+    except click.Abort:
+        report_err('aborted')
+        return 1
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        report_err(e.code)
+        return 1
+    if isinstance(rv, int):
+        return rv
+    return 0
+
+
+class Runner(object):
+    """Runner invokes command lines of the click group over one shared Session
+
+    The session is opened on the first command and reopened after a command
+    fails, in case the failure was a broken connection, or when the connection
+    settings changed since it was opened.
+    """
+
+    def __init__(self, group):
+        self.group = group
+        self.session = None
+
+    def run(self, args):
+        from .tfclient import Session, connection_settings
+
+        try:
+            settings = connection_settings()
+        except ValueError as e:
+            report_err(e)
+            return 1
+        if self.session is not None and settings != self.session.settings:
+            self.close()
+        if self.session is None:
+            session = Session()
+            try:
+                session.__enter__()
+            except Exception as e:
+                report_err(e)
+                return 1
+            self.session = session
+        try:
+            code = invoke(self.group, args)
+        except BaseException:
+            # responses of the interrupted command may still be on the wire
+            self.close()
+            raise
+        if code != 0:
+            self.close()
+        return code
+
+    def close(self):
+        if self.session is not None:
+            self.session.__exit__(None, None, None)
+            self.session = None
@@ -0,0 +1,35 @@
+import posixpath
+
+from .pool import WorkerPool
+from .tfclient import FileServiceSession
+from .tf.boxes.ttypes import LsType
+
+
+def _ls(box_id, inner_dir):
+    with FileServiceSession() as client:
+        return client.ls(box_id, inner_dir)
+
+
+def walk(box_id, root, workers, max_depth=None, descend=None):
+    """walk lists root and the directories under it concurrently
+
+    It yields (inner_dir, depth, items, error) as listings arrive, in no
+    particular order; root is at depth 0. A directory is listed only when it is
+    within max_depth and descend(inner_path, item) returns True. Stopping the
+    iteration drops the listings not yet started.
+    """
+    with WorkerPool(workers) as pool:
+        pool.submit(_ls, box_id, root, tag=(root, 0))
+        while pool.outstanding:
+            (inner_dir, depth), items, error = pool.next_result()
+            yield inner_dir, depth, items, error
+            if error is not None:
+                continue
+            if max_depth is not None and depth >= max_depth:
+                continue
+            for item in items:
+                if item.type != LsType.DIR:
+                    continue
+                inner_path = posixpath.join(inner_dir, item.name)
+                if descend is None or descend(inner_path, item):
+                    pool.submit(_ls, box_id, inner_path, tag=(inner_path, depth + 1))
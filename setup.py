@@ -15,7 +15,7 @@ setup(
     ],
     entry_points="""
     [console_scripts]
-    boxes = bxcli.bxcli:bxcli
+    boxes = bxcli.main:main
     """,
     install_requires=[
         'click',
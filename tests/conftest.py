@@ -0,0 +1,64 @@
+import os
+import socket
+import threading
+import time
+
+import pytest
+
+from bench.server import Store, make_server, populate
+from bxcli import cache, config
+
+BOXES, FILES, LINKS, FANOUT = 3, 20, 12, 5
+
+
+@pytest.fixture(autouse=True)
+def settings(tmp_path, monkeypatch):
+    """settings isolates every test from the settings and caches of the user and of other tests"""
+    for name in list(os.environ):
+        if name.startswith('BXCLI_'):
+            monkeypatch.delenv(name)
+    monkeypatch.setenv('BXCLI_CONFIG', str(tmp_path / 'config.ini'))
+    monkeypatch.setenv('BXCLI_NO_AGENT', '1')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(tmp_path / 'cache'))
+    monkeypatch.setattr(config, '_overrides', {})
+    monkeypatch.setattr(config, '_file_settings', None)
+    monkeypatch.setattr(cache, '_ls_cache', None)
+    monkeypatch.setattr(cache, '_link_indexes', {})
+    return tmp_path
+
+
+@pytest.fixture(scope='session')
+def _server():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    store = Store()
+    config.override('endpoints', '127.0.0.1:{}'.format(port))
+    try:
+        srv = make_server(store)
+    finally:
+        config._overrides.clear()
+    # the server runs until the test process exits
+    threading.Thread(target=srv.serve, daemon=True).start()
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            break
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.02)
+    return store, port
+
+
+@pytest.fixture
+def server(_server, monkeypatch):
+    """server points the client at the stand-in server, filled again for every test, and returns its Store"""
+    store, port = _server
+    with store.lock:
+        store.__init__()
+        populate(store, BOXES, FILES, LINKS, FANOUT)
+    monkeypatch.setenv('BXCLI_HOST', '127.0.0.1')
+    monkeypatch.setenv('BXCLI_PORT', str(port))
+    return store
@@ -0,0 +1,24 @@
+import os
+import time
+
+from bench.rpc import Connection, free_port, start_server
+
+
+def test_server_latency_in_milliseconds():
+    env = dict((k, v) for k, v in os.environ.items() if not k.startswith('BXCLI_'))
+    proc = start_server(free_port(), env, 2, 10, 4, 5, 50)
+    try:
+        connection = Connection(proc.args[proc.args.index('-P') + 1])
+        try:
+            client = connection.clients['BoxService']
+            samples = []
+            for _ in range(3):
+                start = time.perf_counter()
+                client.get(1)
+                samples.append(time.perf_counter() - start)
+        finally:
+            connection.close()
+    finally:
+        proc.kill()
+        proc.wait()
+    assert 0.04 <= min(samples) and max(samples) < 1
@@ -0,0 +1,138 @@
+import time
+
+from bxcli import cache
+from bxcli.cache import LinkIndex, LsCache, normalize
+from bxcli.tf.boxes.ttypes import AddBy, Link, LinkType, LsItem, LsType
+from bxcli.tfclient import BoxServiceSession, FileServiceSession, LinkServiceSession
+
+
+def items(*names):
+    return [LsItem(name=n, type=LsType.FILE) for n in names]
+
+
+def test_normalize():
+    assert normalize('a//b/') == '/a/b'
+    assert normalize('//a') == '/a'
+    assert normalize('/') == '/'
+
+
+def test_ls_cache_invalidate_by_path():
+    c = LsCache(100, 60)
+    for path in ('/', '/a', '/a/b', '/a/b/c', '/ab', '/z'):
+        c.put(('s', 1, path), items('x'))
+    c.put(('s', 2, '/a'), items('x'))
+    c.put(('t', 1, '/a'), items('x'))
+    c.invalidate('s', 1, 'a/b/')
+    kept = set(k for k in c.listings)
+    # the dir, everything under it and its parent go, siblings and other boxes and servers stay
+    assert kept == {('s', 1, '/'), ('s', 1, '/ab'), ('s', 1, '/z'), ('s', 2, '/a'), ('t', 1, '/a')}
+
+
+def test_ls_cache_evicts_least_recently_used():
+    c = LsCache(4, 60)
+    c.put('a', items('1', '2'))
+    c.put('b', items('1', '2'))
+    assert c.get('a') is not None
+    c.put('c', items('1'))
+    assert c.get('b') is None
+    assert c.get('a') is not None and c.get('c') is not None
+    assert c.entries == 3
+    c.put('huge', items(*'12345'))
+    assert c.get('huge') is None
+
+
+def test_ls_cache_expires():
+    c = LsCache(10, 0)
+    c.put('a', items('1'))
+    assert c.get('a') is None
+    assert c.entries == 0
+
+
+def test_file_client_invalidates_what_it_changes(server):
+    with FileServiceSession() as client:
+        assert [i.name for i in client.ls(1, '/d0')] == ['f0', 'f1', 'f2', 'f3', 'f4']
+        assert [i.name for i in client.ls(1, '/d1')] == ['f5', 'f6', 'f7', 'f8', 'f9']
+        # a change made behind the cache is not seen until the listing expires or is invalidated
+        server.dirs[1]['/d1'].pop('f5')
+        client.add(1, '/d0/new', '/tmp/new', AddBy.COPY)
+        assert [i.name for i in client.ls(1, '/d0')] == ['f0', 'f1', 'f2', 'f3', 'f4', 'new']
+        assert [i.name for i in client.ls(1, '/d1')] == ['f5', 'f6', 'f7', 'f8', 'f9']
+        client.innerMove(1, '/d1/f6', '/d0/f6')
+        assert [i.name for i in client.ls(1, '/d1')] == ['f7', 'f8', 'f9']
+
+
+def test_box_cache(server):
+    with BoxServiceSession() as client:
+        assert [b.name for b in client.currentBoxes()] == ['box1', 'box2', 'box3']
+        server.boxes[1].name = 'behind'
+        assert client.get(1).name == 'box1'
+        client.setName(1, 'renamed')
+        assert client.get(1).name == 'renamed'
+
+
+def links():
+    return [Link(1, '/a', '/srv/x/1', LinkType.SOFT), Link(1, 'a/b/', '/srv/x/2', LinkType.HARD),
+            Link(1, '/a-b', '/srv/xy', LinkType.SOFT), Link(2, '/a/c', '/srv/x', LinkType.SOFT),
+            Link(2, '/', '/home/报告', LinkType.SOFT)]
+
+
+def test_link_index_by_destination(settings):
+    index = LinkIndex(path=str(settings / 'links.sqlite'), server='s', ttl=60)
+    index.put(links(), [1, 2, 3], replace_all=True)
+    assert [l.destination for l in index.by_destination('/srv/x')] == ['/srv/x', '/srv/x/1', '/srv/x/2', '/srv/xy']
+    assert [l.destination for l in index.by_destination('/srv/x/')] == ['/srv/x/1', '/srv/x/2']
+    assert [l.destination for l in index.by_destination('/home/报')] == ['/home/报告']
+    assert len(index.by_destination('')) == 5
+    assert index.by_destination('/srv/z') == []
+
+
+def test_link_index_by_inner(settings):
+    index = LinkIndex(path=str(settings / 'links.sqlite'), server='s', ttl=60)
+    index.put(links(), [1, 2], replace_all=True)
+    assert [l.innerPath for l in index.by_inner(1, '/a')] == ['/a', 'a/b/']
+    assert [l.innerPath for l in index.by_inner(1, '/')] == ['/a', '/a-b', 'a/b/']
+    assert [l.innerPath for l in index.by_inner(1, 'a/b')] == ['a/b/']
+    assert [l.innerPath for l in index.by_inner(2, '/')] == ['/', '/a/c']
+    assert index.by_inner(3, '/') == []
+
+
+def test_link_index_staleness(settings):
+    index = LinkIndex(path=str(settings / 'links.sqlite'), server='s', ttl=60)
+    assert index.empty()
+    index.put(links(), [1, 2, 3], replace_all=True)
+    assert index.stale([1, 2, 3, 4]) == [4]
+    index.invalidate(2)
+    assert index.stale([1, 2, 3]) == [2]
+    index.invalidate_destination('/srv/x/1')
+    assert index.stale([1, 2, 3]) == [1, 2]
+    index.put([], [1])
+    assert index.by_inner(1) == []
+    index.drop([2])
+    assert sorted(index.indexed()) == [1, 3]
+    # another process sees the changes on its next use
+    other = LinkIndex(path=index.path, server='s', ttl=60)
+    assert sorted(other.indexed()) == [1, 3]
+    assert LinkIndex(path=index.path, server='t', ttl=60).empty()
+
+
+def test_link_index_rebuilds_old_schema(settings):
+    path = str(settings / 'links.sqlite')
+    index = LinkIndex(path=path, server='s', ttl=60)
+    index.put(links(), [1, 2], replace_all=True)
+    index.db().execute('PRAGMA user_version = 0')
+    index.close()
+    assert LinkIndex(path=path, server='s', ttl=60).empty()
+
+
+def test_link_client_invalidates_index(server):
+    index = cache.link_index()
+    with LinkServiceSession() as client:
+        index.put(client.lsAll(), [1, 2, 3], replace_all=True)
+        assert index.stale([1, 2, 3]) == []
+        client.create(2, '/d0/f1', '/srv/new', LinkType.SOFT)
+        assert index.stale([1, 2, 3]) == [2]
+        index.put(client.lsBox(2), [2])
+        assert '/srv/new' in [l.destination for l in index.by_destination('/srv/')]
+        client.removeByDestination('/srv/new')
+        assert index.stale([1, 2, 3]) == [2]
+    assert time.time() - index.boxes[1] < 60
@@ -0,0 +1,87 @@
+import os
+
+import pytest
+
+from bxcli import config
+from bxcli.config import Endpoint
+
+
+def write_config(settings, **values):
+    with open(os.environ['BXCLI_CONFIG'], 'w') as f:
+        f.write('[bxcli]\n')
+        for name, value in values.items():
+            f.write('{} = {}\n'.format(name, value))
+    config._file_settings = None
+
+
+def test_setting_precedence(settings, monkeypatch):
+    assert config.cache_ttl() == 60.0
+    write_config(settings, cache_ttl=1)
+    assert config.cache_ttl() == 1.0
+    monkeypatch.setenv('BXCLI_CACHE_TTL', '2')
+    assert config.cache_ttl() == 2.0
+    config.override('cache_ttl', 3)
+    assert config.cache_ttl() == 3.0
+
+
+def test_empty_environment_value_falls_through(settings, monkeypatch):
+    write_config(settings, protocol='compact')
+    monkeypatch.setenv('BXCLI_PROTOCOL', '')
+    assert config.protocol() == 'compact'
+
+
+def test_scoped_overrides_restore(settings):
+    config.override('debug', True)
+    with config.scoped_overrides():
+        config.override('debug', False)
+        config.override('port', 1)
+        assert not config.debug()
+    assert config.debug()
+    assert config.port() == 6077
+
+
+def test_scoped_environment_replaces_and_restores(settings, monkeypatch):
+    monkeypatch.setenv('BXCLI_PORT', '1000')
+    with config.scoped_environment({'BXCLI_HOST': 'other'}):
+        assert 'BXCLI_PORT' not in os.environ
+        assert config.endpoints() == [Endpoint('other', 6077, None)]
+    assert os.environ['BXCLI_PORT'] == '1000'
+    assert 'BXCLI_HOST' not in os.environ
+
+
+def test_endpoints_default(settings):
+    assert config.endpoints() == [Endpoint('localhost', 6077, None)]
+
+
+def test_endpoints_list_wins_within_a_layer(settings, monkeypatch):
+    monkeypatch.setenv('BXCLI_HOST', 'ignored')
+    monkeypatch.setenv('BXCLI_SOCKET', '/run/ignored.sock')
+    monkeypatch.setenv('BXCLI_ENDPOINTS', 'a:1, unix:/run/b.sock,[::1]:3')
+    assert config.endpoints() == [Endpoint('a', 1, None), Endpoint(None, None, '/run/b.sock'),
+                                  Endpoint('::1', 3, None)]
+
+
+def test_address_options_win_over_environment(settings, monkeypatch):
+    monkeypatch.setenv('BXCLI_ENDPOINTS', 'localhost:16077')
+    config.override('host', 'option')
+    assert config.endpoints() == [Endpoint('option', 6077, None)]
+
+
+def test_port_option_wins_over_environment_socket(settings, monkeypatch):
+    monkeypatch.setenv('BXCLI_SOCKET', '/run/env.sock')
+    monkeypatch.setenv('BXCLI_HOST', 'envhost')
+    config.override('port', 1)
+    assert config.endpoints() == [Endpoint('envhost', 1, None)]
+
+
+def test_environment_address_wins_over_file(settings, monkeypatch):
+    write_config(settings, endpoints='file:1')
+    assert config.endpoints() == [Endpoint('file', 1, None)]
+    monkeypatch.setenv('BXCLI_SOCKET', '/run/env.sock')
+    assert config.endpoints() == [Endpoint(None, None, '/run/env.sock')]
+
+
+def test_empty_endpoints_rejected(settings, monkeypatch):
+    monkeypatch.setenv('BXCLI_ENDPOINTS', ',')
+    with pytest.raises(ValueError):
+        config.endpoints()
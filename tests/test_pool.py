@@ -0,0 +1,33 @@
+import socket
+
+from bxcli.pool import WorkerPool
+from bxcli.tfclient import BoxServiceSession
+
+
+def get(id):
+    with BoxServiceSession() as client:
+        return client.get(id).name
+
+
+def test_pool_results(server):
+    with WorkerPool(3) as pool:
+        for id in (1, 2, 3, 9):
+            pool.submit(get, id, tag=id)
+        results = dict((tag, (result, error)) for tag, result, error in (pool.next_result() for _ in range(4)))
+    assert [results[id][0] for id in (1, 2, 3)] == ['box1', 'box2', 'box3']
+    assert results[9][1] is not None
+
+
+def test_pool_unreachable_server(settings, monkeypatch):
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    monkeypatch.setenv('BXCLI_PORT', str(port))
+    monkeypatch.setenv('BXCLI_HOST', '127.0.0.1')
+    with WorkerPool(2) as pool:
+        for id in range(5):
+            pool.submit(get, id, tag=id)
+        # every call gets its error, none waits forever
+        results = [pool.next_result() for _ in range(5)]
+    assert sorted(tag for tag, _, _ in results) == list(range(5))
+    assert all(error is not None for _, _, error in results)
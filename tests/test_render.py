@@ -0,0 +1,38 @@
+import io
+
+from bxcli.render import PlainRenderer, TableRenderer
+from bxcli.tf.boxes.ttypes import LsItem, LsType
+
+
+def render(renderer_class, names, **kwargs):
+    out = io.StringIO()
+    with renderer_class(('type', 'name'), lambda i: (LsType._VALUES_TO_NAMES[i.type], i.name), LsItem,
+                        out=out, **kwargs) as r:
+        for name in names:
+            r.record(LsItem(name=name, type=LsType.FILE))
+    return out.getvalue().splitlines()
+
+
+def test_table_aligns_wide_characters():
+    lines = render(TableRenderer, ['a', '报告.txt', 'ｆｕｌｌ'], sample=10)
+    assert lines == [
+        '+------+----------+',
+        '| type | name     |',
+        '+------+----------+',
+        '| FILE | a        |',
+        '| FILE | 报告.txt |',
+        '| FILE | ｆｕｌｌ |',
+        '+------+----------+',
+    ]
+
+
+def test_table_rows_after_the_sample():
+    lines = render(TableRenderer, ['ab', 'abcdef'], sample=1)
+    assert lines[3:] == ['| FILE | ab   |', '| FILE | abcdef |', '+------+------+']
+
+
+def test_plain_aligns_wide_characters():
+    lines = render(PlainRenderer, ['报告', 'x'], sample=10)
+    assert lines == ['FILE  报告', 'FILE  x']
+    lines = render(PlainRenderer, ['报', 'xyz', 'ab'], sample=10)
+    assert [l.index('  ') for l in lines] == [4, 4, 4]
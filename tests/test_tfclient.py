@@ -0,0 +1,96 @@
+import pytest
+from thrift.Thrift import TApplicationException
+
+from bxcli import config
+from bxcli.tf.boxes.ttypes import ServiceException
+from bxcli.tfclient import (BoxServiceSession, FileServiceSession, Pipeline, Session, matching_session, pipelined,
+                            shared_session, stream_list, uncached)
+
+
+def names(items):
+    return [i.name for i in items]
+
+
+def test_pipelined_results_in_order(server):
+    dirs = [(1, '/d0'), (2, '/d1'), (3, '/d3'), (1, '/nope'), (2, '/d2')]
+    with FileServiceSession() as client:
+        expected = [names(uncached(client).ls(*d)) for d in dirs[:3]]
+        results = list(pipelined(uncached(client), 'ls', dirs, 2))
+    assert [args for args, _, _ in results] == dirs
+    assert [names(r) for _, r, _ in results[:3]] == expected
+    assert isinstance(results[3][2], ServiceException)
+    assert names(results[4][1]) == ['f10', 'f11', 'f12', 'f13', 'f14']
+
+
+def test_pipelined_error_in_the_middle(server):
+    calls = [(1, '/d0/f0'), (1, '/d0/nope'), (1, '/d0/f1'), (9, '/d0/f2'), (1, '/d0/f2')]
+    with FileServiceSession() as client:
+        results = list(pipelined(client, 'remove', calls, 8))
+        assert [type(e) if e else None for _, _, e in results] == [None, ServiceException, None, ServiceException, None]
+        # the failed responses were read completely, the connection is still in step
+        assert names(client.ls(1, '/d0')) == ['f3', 'f4']
+
+
+def test_pipeline_checks_seqids(server):
+    with BoxServiceSession() as client:
+        pipeline = Pipeline(client, 4)
+        pipeline.submit('get', (1,))
+        pipeline.submit('get', (2,))
+        seqid, method, args, tag = pipeline.pending[0]
+        pipeline.pending[0] = (seqid + 1, method, args, tag)
+        with pytest.raises(TApplicationException) as e:
+            pipeline.complete()
+        assert e.value.type == TApplicationException.BAD_SEQUENCE_ID
+
+
+def test_pipeline_tells_caching_client(server):
+    with FileServiceSession() as client:
+        assert names(client.ls(1, '/d0')) == ['f0', 'f1', 'f2', 'f3', 'f4']
+        list(pipelined(client, 'remove', [(1, '/d0/f0')], 4))
+        assert names(client.ls(1, '/d0')) == ['f1', 'f2', 'f3', 'f4']
+
+
+def test_stream_list(server):
+    with FileServiceSession() as client:
+        assert names(stream_list(client, 'ls', 1, '/d1')) == names(uncached(client).ls(1, '/d1'))
+
+
+def test_stream_list_abandoned(server):
+    with FileServiceSession() as client:
+        stream = stream_list(client, 'ls', 1, '/d1')
+        assert next(stream).name == 'f5'
+        stream.close()
+        # the rest of the response was read and dropped
+        assert names(uncached(client).ls(1, '/d2')) == ['f10', 'f11', 'f12', 'f13', 'f14']
+
+
+def test_stream_list_error(server):
+    with FileServiceSession() as client:
+        with pytest.raises(ServiceException):
+            list(stream_list(client, 'ls', 9, '/'))
+        assert names(uncached(client).ls(1, '/')) == ['d0', 'd1', 'd2', 'd3']
+
+
+def test_session_shares_one_connection(server):
+    with Session() as session:
+        with BoxServiceSession() as boxes, FileServiceSession() as files:
+            assert boxes.currentBoxes()
+            assert files.ls(1, '/')
+        assert session.transport.isOpen()
+    assert session.transport is None
+
+
+def test_session_not_shared_with_other_settings(server):
+    with Session():
+        with shared_session() as shared:
+            assert shared is matching_session()
+        config.override('port', 1)
+        assert matching_session() is None
+        with pytest.raises(Exception):
+            with BoxServiceSession() as client:
+                client.currentBoxes()
+
+
+def test_session_exit_without_connection():
+    session = Session()
+    session.__exit__(None, None, None)